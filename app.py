@@ -1,36 +1,198 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file
-from models import db, User, Vital, Anomaly, Alert, PatientDoctor
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file, g, make_response
+from flask.json.provider import DefaultJSONProvider
+from models import db, User, Vital, Anomaly, Alert, PatientDoctor, Prediction, SEVERITY_LEVELS, SEVERITY_RANKS
+from sqlalchemy import func, case, inspect, text, update, event, select, lambda_stmt, and_, or_
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import selectinload, joinedload, aliased
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import wraps, lru_cache
+from types import MappingProxyType
+from cachetools import TTLCache
+import orjson
 import os
+import re
+import hashlib
+import glob
+import shutil
+import importlib.util
 import sys
 import logging
+import logging.handlers
+import queue
+import atexit
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 import pandas as pd
 import io
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')  # Use non-interactive backend
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, PageBreak, Image
-from reportlab.lib import colors
-from reportlab.lib.enums import TA_CENTER, TA_LEFT
-
-# Configure logging
+
+# Configure logging - request threads only enqueue records, a background
+# listener thread does the formatting and the stdout/file writes
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_handlers = [logging.StreamHandler(sys.stdout), logging.FileHandler('healio.log')]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+_queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))  # Only merge args; the listener applies the real format
 logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('healio.log')
-    ]
+    level=os.environ.get('HEALIO_LOG_LEVEL', 'INFO').upper(),
+    handlers=[_queue_handler]
 )
+
+def start_log_listener():
+    """Start the thread that drains the log queue (again in forked workers, which don't inherit it)"""
+    global _log_listener
+    _queue_handler.queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(_queue_handler.queue, *_log_handlers, respect_handler_level=True)
+    _log_listener.start()
+
+start_log_listener()
+os.register_at_fork(after_in_child=start_log_listener)
+atexit.register(lambda: _log_listener.stop())  # Drain pending records on shutdown
 logger = logging.getLogger(__name__)
 
+# CSV column aliases for vitals uploads (normalized variant -> Vital column)
+VITAL_COLUMN_VARIANTS = {
+    'heart_rate': ['heart_rate', 'hr', 'heart rate', 'heartrate', 'pulse', 'bpm'],
+    'blood_pressure_systolic': ['blood_pressure_systolic', 'sbp', 'systolic', 'systolic_bp', 'systolic bp', 'bp_systolic', 'bp systolic', 'blood_pressure_sys'],
+    'blood_pressure_diastolic': ['blood_pressure_diastolic', 'dbp', 'diastolic', 'diastolic_bp', 'diastolic bp', 'bp_diastolic', 'bp diastolic', 'blood_pressure_dia'],
+    'oxygen_saturation': ['oxygen_saturation', 'spo2', 'sp_o2', 'oxygen', 'oxygen sat', 'o2_sat', 'o2 sat', 'saturation'],
+    'respiratory_rate': ['respiratory_rate', 'rr', 'respiratory rate', 'breathing_rate', 'breathing rate', 'respiration'],
+    'body_temperature': ['body_temperature', 'temp', 'temperature', 'body temp', 'body_temp', 'fever'],
+    'steps': ['steps', 'step_count', 'step count', 'walking_steps', 'walking steps'],
+    'sleep_hours': ['sleep_hours', 'sleep', 'sleep hours', 'sleep_time', 'sleep time', 'sleep_duration', 'sleep duration'],
+    'energy_level': ['energy_level', 'energy', 'energy level', 'energy_lvl', 'vitality']
+}
+# Runs of whitespace/dashes collapse to a single underscore
+_COLUMN_SEPARATORS_RE = re.compile(r'[\s\-]+')
+
+def normalize_column_name(name):
+    """Normalize a CSV header for alias lookup ('Heart-Rate ' -> 'heart_rate')"""
+    return _COLUMN_SEPARATORS_RE.sub('_', str(name).strip()).casefold()
+
+# Parse uploads with Arrow's multithreaded CSV reader when pyarrow is installed
+CSV_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'c'
+
+VITAL_COLUMN_ALIASES = {
+    normalize_column_name(variant): standard_name
+    for standard_name, variants in VITAL_COLUMN_VARIANTS.items()
+    for variant in variants
+}
+
+# Anomaly severity ordering (rank 1 = low ... 4 = critical) and health score penalty per anomaly
+SEVERITY_PENALTIES = {'critical': 10, 'high': 5, 'medium': 2}
+
+# Model risk head outputs -> display names, and risk probability -> anomaly severity
+# (digitize with right=True: <= 0.5 low, (0.5, 0.7] medium, > 0.7 high)
+DISEASE_NAMES = MappingProxyType({
+    'cardio': 'Cardiovascular',
+    'respiratory': 'Respiratory',
+    'metabolic': 'Metabolic',
+    'neurological': 'Neurological',
+})
+RISK_THRESHOLD = 0.5
+RISK_SEVERITY_BINS = np.array([0.5, 0.7])
+RISK_SEVERITY_LABELS = ('low', 'medium', 'high')
+# Per severity bucket: (alert severity, label) for the disease-risk alert, None = no alert
+RISK_ALERT_LEVELS = (None, ('high', 'Moderate'), ('critical', 'High'))
+
+# Overall model alert -> (anomaly type, anomaly severity, description lead-in, alert severity, alert message)
+PREDICTION_ALERT_RULES = MappingProxyType({
+    'HIGH RISK': ('quantum_high_risk', 'high', 'High risk detected', 'critical',
+                  "HIGH RISK detected by Quantum DL Model. Immediate attention recommended."),
+    'EARLY WARNING': ('quantum_early_warning', 'medium', 'Early warning detected', 'high',
+                      "Early warning detected by Quantum DL Model. Monitor closely."),
+})
+
+# Short-lived in-process caches for data read far more often than it changes
+_doctor_cache = TTLCache(maxsize=1, ttl=300)
+_dashboard_cache = TTLCache(maxsize=4096, ttl=30)
+# anomaly id -> (report version, PDF bytes or, for big reports, the path of its file in REPORT_DIR),
+# bounded by the total size of the in-memory PDFs (a path only counts its few dozen characters)
+_pdf_cache = TTLCache(maxsize=64 * 1024 * 1024, ttl=3600, getsizeof=lambda entry: len(entry[1]))
+REPORT_SPOOL_SIZE = 1024 * 1024  # Reports bigger than this are built and kept on disk only
+_cache_lock = threading.Lock()
+
+# Vitals chart series key -> Vital column (vitals / patient detail pages)
+CHART_VITAL_COLUMNS = {
+    'heart_rate': Vital.heart_rate,
+    'oxygen_saturation': Vital.oxygen_saturation,
+    'blood_pressure_systolic': Vital.blood_pressure_systolic,
+    'blood_pressure_diastolic': Vital.blood_pressure_diastolic,
+    'respiratory_rate': Vital.respiratory_rate,
+    'temperature': Vital.body_temperature,
+    'steps': Vital.steps,
+    'sleep_hours': Vital.sleep_hours,
+}
+
+# Model input features (in model column order) and their fill values
+MODEL_FEATURE_DEFAULTS = {
+    'heart_rate': 72,
+    'blood_pressure_systolic': 120,
+    'blood_pressure_diastolic': 80,
+    'oxygen_saturation': 98,
+    'sleep_hours': 0,
+}
+
+# sleep_hours -> sleep_state lookup: searchsorted over the bucket edges gives
+# 0 for <= 0, 1 for (0, 0.25], 2 for (0.25, 0.5], 3 for > 0.5, which the
+# codes table maps to the model's states (0=awake, 3=REM, 1=light, 2=deep)
+SLEEP_STATE_EDGES = np.array([0, 0.25, 0.5], dtype=np.float32)
+SLEEP_STATE_CODES = np.array([0, 3, 1, 2], dtype=np.float32)
+
+# Case report: disease categories, the physiological features behind each,
+# and how those features are explained to the doctor
+CASE_DISEASE_FEATURES = MappingProxyType({
+    "Neurological": ("sleep_entropy", "sleep_transition_rate", "hr_irregularity"),
+    "Cardiovascular": ("hr_mean", "sbp_trend", "bp_gap"),
+    "Respiratory": ("spo2_trend", "spo2_variability", "hr_mean", "bp_gap"),
+    "Infectious": ("hr_mean", "hrv"),
+    "Metabolic": ("bp_gap", "hr_mean"),
+    "Mental Health": ("sleep_entropy", "sleep_transition_rate"),
+})
+CASE_FEATURE_EXPLAIN = MappingProxyType({
+    "sleep_entropy": "high sleep fragmentation",
+    "sleep_transition_rate": "frequent sleep stage changes",
+    "hrv": "abnormal heart rate variability",
+    "hr_irregularity": "irregular heart rate pattern",
+    "hr_mean": "abnormal heart rate",
+    "sbp_trend": "unstable systolic blood pressure",
+    "bp_gap": "abnormal pulse pressure",
+    "spo2_trend": "falling oxygen saturation",
+    "spo2_variability": "high oxygen saturation swings",
+})
+# Lowercased forms anomaly types are matched against (one per disease), and
+# each disease's feature indices as a -1 padded (disease, feature slot) table
+CASE_DISEASE_TYPE_KEYS = np.array([d.lower().replace(' ', '_') for d in CASE_DISEASE_FEATURES])
+CASE_DISEASE_NAMES_LOWER = np.array([d.lower() for d in CASE_DISEASE_FEATURES])
+_case_feature_idx = {feat: i for i, feat in enumerate(CASE_FEATURE_EXPLAIN)}
+CASE_DISEASE_FEATURE_COUNTS = np.array([len(feats) for feats in CASE_DISEASE_FEATURES.values()])
+CASE_DISEASE_FEATURE_INDEX = np.full((len(CASE_DISEASE_FEATURES), CASE_DISEASE_FEATURE_COUNTS.max()), -1)
+for _disease_i, _feats in enumerate(CASE_DISEASE_FEATURES.values()):
+    CASE_DISEASE_FEATURE_INDEX[_disease_i, :len(_feats)] = [_case_feature_idx[feat] for feat in _feats]
+
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify/tojson through orjson; numpy values serialize as-is, keys stay sorted like Flask's default"""
+    # Unlike the default provider, datetimes come out as ISO 8601 and NaN as null
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Responses take orjson's bytes directly, without the round trip through str
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.option)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = os.urandom(24)
 # Use absolute path for database to avoid path issues
 import os
@@ -40,31 +202,133 @@ os.makedirs(os.path.dirname(db_path), exist_ok=True)
 db_path_uri = db_path.replace('\\', '/')
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path_uri}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# One pooled connection per thread that can hit the DB at once: gunicorn's
+# request threads plus the prediction and report job pools. LIFO hands out the
+# most recently used connection, whose SQLite page cache is still warm.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 10,
+    'pool_use_lifo': True,
+}
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tune every new SQLite connection for a read-heavy, single-host workload"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=-64000')  # 64 MB page cache
+    cursor.execute('PRAGMA mmap_size=268435456')  # 256 MB memory-mapped I/O
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
 
 db.init_app(app)
 
+class PredictionBatcher:
+    """Coalesces concurrent uploads into one batched model call on a worker thread"""
+    
+    def __init__(self, predict_batch_fn, max_batch=16, max_wait=0.02):
+        self.predict_batch_fn = predict_batch_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.SimpleQueue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+    
+    def submit(self, model_array):
+        """Queue one upload's feature matrix, returning a Future for its prediction"""
+        future = Future()
+        self._queue.put((model_array, future))
+        self._ensure_worker()
+        return future
+    
+    def _ensure_worker(self):
+        # Started lazily (and restarted after a fork) so only live processes own a thread
+        if self._worker is None or not self._worker.is_alive():
+            with self._worker_lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name='healio-predict', daemon=True)
+                    self._worker.start()
+    
+    def _run(self):
+        while True:
+            # Block for the first request, then gather whatever else arrives within max_wait
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                results = self.predict_batch_fn([model_array for model_array, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
 # Pre-import model at startup to avoid blocking requests
-print("[APP] Pre-importing healio_model at startup...", flush=True)
+logger.info("Pre-importing healio_model at startup...")
 try:
     import healio_model
-    print(f"[APP] Model module pre-imported successfully: {healio_model}", flush=True)
     logger.info("Model module pre-imported successfully")
+    # Uploads hand their features to a shared batcher instead of calling the model directly
+    app.config['PREDICT_BATCHER'] = PredictionBatcher(healio_model.predict_from_csv_batch)
 except Exception as e:
-    print(f"[APP] Warning: Could not pre-import model: {e}", flush=True)
     logger.warning(f"Could not pre-import model: {e}")
+    app.config['PREDICT_BATCHER'] = None
+app.config.setdefault('PREDICT_TIMEOUT', 120)  # Seconds a prediction job waits for its batch
+# Uploads return once vitals are stored; these threads finish the prediction and anomalies
+_prediction_jobs = ThreadPoolExecutor(max_workers=4, thread_name_prefix='healio-job')
+# Case report PDFs are rendered here rather than on request threads
+app.config.setdefault('REPORT_TIMEOUT', 120)  # Seconds a download waits for its report to build
+# Every finished report is written here, so a poll or download on any worker can serve it
+app.config.setdefault('REPORT_DIR', os.path.join(os.path.dirname(db_path), 'reports'))
+_report_jobs = ThreadPoolExecutor(max_workers=2, thread_name_prefix='healio-report')
+_report_futures = {}  # anomaly id -> (report version, Future) of the latest build
 
 # Create tables
 with app.app_context():
     try:
         db.create_all()
     except Exception as e:
-        print(f"Warning: Error creating tables: {e}")
+        logger.warning(f"Error creating tables: {e}")
         # Try to recreate all tables
         try:
             db.drop_all()
             db.create_all()
         except Exception as e2:
-            print(f"Error recreating tables: {e2}")
+            logger.error(f"Error recreating tables: {e2}")
+    
+    # create_all() doesn't alter existing tables - add and backfill newer columns
+    try:
+        anomaly_columns = {col['name'] for col in inspect(db.engine).get_columns('anomalies')}
+        if 'severity_rank' not in anomaly_columns:
+            db.session.execute(text('ALTER TABLE anomalies ADD COLUMN severity_rank SMALLINT'))
+            db.session.execute(update(Anomaly).values(
+                severity_rank=case(SEVERITY_RANKS, value=Anomaly.severity, else_=1)
+            ))
+            db.session.commit()
+        # Same for indexes added to tables that already exist
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+        # ...and single-column indexes since covered by the composite ones
+        for index_name in ('ix_vitals_patient_id', 'ix_anomalies_patient_id', 'ix_anomalies_assigned_doctor_id',
+                           'ix_alerts_patient_id', 'ix_alerts_is_read'):
+            db.session.execute(text(f'DROP INDEX IF EXISTS {index_name}'))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f"Error migrating schema: {e}")
 
 # Error handler for API routes to return JSON
 @app.errorhandler(404)
@@ -79,6 +343,159 @@ def internal_error(error):
         return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
     return render_template('500.html'), 500
 
+def current_user():
+    """Return the logged-in user, loading it at most once per request"""
+    if 'current_user' not in g:
+        g.current_user = db.session.get(User, session['user_id']) if 'user_id' in session else None
+    return g.current_user
+
+def get_doctor_directory():
+    """Return lightweight rows for every doctor, cached for a few minutes"""
+    with _cache_lock:
+        doctors = _doctor_cache.get('all')
+    if doctors is None:
+        doctors = db.session.query(
+            User.id, User.first_name, User.last_name, User.specialization,
+            User.persons_treated, User.license_number
+        ).filter(User.user_type == 'doctor').order_by(User.id).all()
+        with _cache_lock:
+            _doctor_cache['all'] = doctors
+    return doctors
+
+def daily_anomaly_map(*criteria, with_count=False):
+    """Map each day (string key for JSON) to the highest severity of the matching anomalies, grouped in SQL"""
+    try:
+        daily_rows = db.session.query(
+            func.date(Anomaly.detected_at), func.max(Anomaly.severity_rank), func.count(Anomaly.id)
+        ).filter(*criteria).group_by(func.date(Anomaly.detected_at)).all()
+    except Exception:
+        return {}  # If Anomaly table doesn't exist yet, just skip
+    
+    daily_anomaly_status = {}
+    for day, max_rank, count in daily_rows:
+        daily_anomaly_status[str(day)] = {
+            'has_anomaly': True,
+            'severity': SEVERITY_LEVELS[(max_rank or 1) - 1]
+        }
+        if with_count:
+            daily_anomaly_status[str(day)]['count'] = count
+    return daily_anomaly_status
+
+def get_anomaly_summary(patient_id):
+    """Return (health score penalty, pending count, per-day consistency map) for a patient, cached briefly"""
+    with _cache_lock:
+        summary = _dashboard_cache.get(patient_id)
+    if summary is not None:
+        return summary
+    
+    # Health score penalty and pending (unverified) count in a single aggregate pass
+    anomaly_penalty, pending_count = 0, 0
+    try:
+        anomaly_penalty, pending_count = db.session.query(
+            func.coalesce(func.sum(case(SEVERITY_PENALTIES, value=Anomaly.severity, else_=0)), 0),
+            func.coalesce(func.sum(case((Anomaly.case_status == 'pending', 1), else_=0)), 0)
+        ).filter(Anomaly.patient_id == patient_id).one()
+    except Exception:
+        pass
+    
+    # Get highest anomaly severity per day for the consistency map
+    daily_anomaly_status = daily_anomaly_map(Anomaly.patient_id == patient_id)
+    
+    summary = (anomaly_penalty, pending_count, daily_anomaly_status)
+    with _cache_lock:
+        _dashboard_cache[patient_id] = summary
+    return summary
+
+def get_vitals_chart_json(patient_id, latest_vital_id):
+    """Return the dashboard's last-24-readings chart data as JSON, reused until a newer vital arrives"""
+    cache_key = ('chart', patient_id)
+    with _cache_lock:
+        cached = _dashboard_cache.get(cache_key)
+    if cached is not None and cached[0] == latest_vital_id:
+        return cached[1]
+    
+    recent_vitals = db.session.execute(lambda_stmt(
+        lambda: select(Vital.heart_rate, Vital.oxygen_saturation, Vital.recorded_at)
+        .where(Vital.patient_id == patient_id).order_by(Vital.recorded_at.desc()).limit(24)
+    )).all()
+    # Reverse to get chronological order (oldest first)
+    chart_json = orjson.dumps([
+        {
+            'heart_rate': vital.heart_rate or None,
+            'oxygen_saturation': vital.oxygen_saturation or None,
+            'timestamp': vital.recorded_at.strftime('%H:%M') if vital.recorded_at else None
+        }
+        for vital in reversed(recent_vitals)
+    ]).decode()
+    
+    with _cache_lock:
+        _dashboard_cache[cache_key] = (latest_vital_id, chart_json)
+    return chart_json
+
+def latest_vitals_ascending(*criteria, columns=None, limit=30):
+    """Newest `limit` vitals matching criteria, oldest first - both orderings happen in one SQL query"""
+    newest = select(*(columns or (Vital,))).where(*criteria).order_by(Vital.recorded_at.desc()).limit(limit).subquery()
+    if columns is None:
+        vital = aliased(Vital, newest)
+        return db.session.scalars(select(vital).order_by(vital.recorded_at.asc())).all()
+    return db.session.execute(select(newest).order_by(newest.c.recorded_at.asc())).all()
+
+def get_case_vitals(patient_id, detected_at, limit=30):
+    """A case's last `limit` vitals up to detection (oldest first) and the patient's latest vital, from one windowed query"""
+    in_case = Vital.recorded_at <= detected_at
+    ranked = select(
+        Vital,
+        in_case.label('in_case'),
+        func.row_number().over(order_by=Vital.recorded_at.desc()).label('overall_rank'),
+        func.row_number().over(partition_by=in_case, order_by=Vital.recorded_at.desc()).label('case_rank')
+    ).where(Vital.patient_id == patient_id).subquery()
+    vital = aliased(Vital, ranked)
+    rows = db.session.execute(
+        select(vital, ranked.c.in_case, ranked.c.overall_rank, ranked.c.case_rank)
+        .where(or_(ranked.c.overall_rank == 1, and_(ranked.c.in_case, ranked.c.case_rank <= limit)))
+        .order_by(ranked.c.recorded_at.asc())
+    ).all()
+    related_vitals = [row[0] for row in rows if row.in_case and row.case_rank <= limit]
+    latest_vital = next((row[0] for row in rows if row.overall_rank == 1), None)
+    return related_vitals, latest_vital
+
+def case_disease_matrix(anomaly_types):
+    """Boolean (anomaly, disease) matrix: does each anomaly type map to each case report disease"""
+    types = np.char.lower(np.array(anomaly_types, dtype=str))[:, np.newaxis]
+    # 'cardiovascular' in 'quantum_cardiovascular_risk', or the type is part of the disease name
+    return (
+        (np.char.find(types, CASE_DISEASE_TYPE_KEYS) >= 0)
+        | (np.char.find(CASE_DISEASE_NAMES_LOWER, types) >= 0)
+    )
+
+def case_map_points(matches, risk_scores):
+    """3D map (disease, feature, risk) coordinates, one per feature of each matched (anomaly, disease)"""
+    anomaly_i, disease_i = np.nonzero(matches)
+    counts = CASE_DISEASE_FEATURE_COUNTS[disease_i]
+    x = np.repeat(disease_i, counts)
+    z = np.repeat(np.asarray(risk_scores, dtype=float)[anomaly_i], counts)
+    # Slot of each point within its disease's feature list: 0..count-1 per pair
+    slots = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    y = CASE_DISEASE_FEATURE_INDEX[x, slots]
+    return x, y, z
+
+def transpose_vital_rows(rows):
+    """Split (recorded_at, *CHART_VITAL_COLUMNS) rows into formatted dates and per-series value tuples"""
+    if not rows:
+        return [], {key: () for key in CHART_VITAL_COLUMNS}
+    recorded_at, *series = zip(*rows)
+    return [d.strftime('%Y-%m-%d %H:%M') for d in recorded_at], dict(zip(CHART_VITAL_COLUMNS, series))
+
+def invalidate_doctor_directory():
+    """Drop the cached doctor list after a doctor is added or updated"""
+    with _cache_lock:
+        _doctor_cache.clear()
+
+def invalidate_dashboard(patient_id):
+    """Drop a patient's cached dashboard data after their anomalies change"""
+    with _cache_lock:
+        _dashboard_cache.pop(patient_id, None)
+
 # Authentication decorators
 def login_required(f):
     @wraps(f)
@@ -96,7 +513,7 @@ def patient_required(f):
             if request.is_json or request.path.startswith('/api/') or request.path.endswith('-csv'):
                 return jsonify({'status': 'error', 'message': 'Authentication required'}), 401
             return redirect(url_for('login'))
-        user = User.query.get(session['user_id'])
+        user = current_user()
         if not user or user.user_type != 'patient':
             # Check if this is an API request (JSON expected)
             if request.is_json or request.path.startswith('/api/') or request.path.endswith('-csv'):
@@ -114,7 +531,7 @@ def doctor_required(f):
             if request.is_json or request.path.startswith('/api/'):
                 return jsonify({'status': 'error', 'message': 'Authentication required'}), 401
             return redirect(url_for('login'))
-        user = User.query.get(session['user_id'])
+        user = current_user()
         if not user or user.user_type != 'doctor':
             # Check if this is an API request (JSON expected)
             if request.is_json or request.path.startswith('/api/'):
@@ -129,8 +546,8 @@ def doctor_required(f):
 @app.route('/')
 def index():
     if 'user_id' in session:
-        user = User.query.get(session['user_id'])
-        if user.user_type == 'patient':
+        # user_type is stored at login, no need to load the user here
+        if session.get('user_type') == 'patient':
             return redirect(url_for('patient_dashboard'))
         else:
             return redirect(url_for('doctor_dashboard'))
@@ -152,8 +569,14 @@ def login():
         user = User.query.filter_by(email=email).first()
         
         if user and user.check_password(password):
+            # Upgrade legacy/outdated hashes while we have the plaintext
+            if user.password_needs_rehash():
+                user.set_password(password)
+                db.session.commit()
+            
             session['user_id'] = user.id
             session['user_type'] = user.user_type
+            session.permanent = True  # Set once here rather than on every upload
             flash('Login successful!', 'success')
             
             if user.user_type == 'patient':
@@ -224,6 +647,8 @@ def register():
         try:
             db.session.add(user)
             db.session.commit()
+            if user_type == 'doctor':
+                invalidate_doctor_directory()
             flash('Registration successful! Please login.', 'success')
             return redirect(url_for('login'))
         except Exception as e:
@@ -243,33 +668,32 @@ def logout():
 @app.route('/patient/dashboard')
 @patient_required
 def patient_dashboard():
-    user = User.query.get(session['user_id'])
+    user = current_user()
+    patient_id = user.id
     
-    # Get latest vitals
-    latest_vital = Vital.query.filter_by(patient_id=user.id).order_by(Vital.recorded_at.desc()).first()
-    
-    # Get recent vitals for chart (last 24 hours, actual data from CSV)
-    recent_vitals_24h = Vital.query.filter_by(patient_id=user.id).order_by(Vital.recorded_at.desc()).limit(24).all()
+    # Dashboard queries run on every page view - lambda_stmt caches their compiled SQL
+    # Get latest vital
+    latest_vital = db.session.scalars(lambda_stmt(
+        lambda: select(Vital).where(Vital.patient_id == patient_id).order_by(Vital.recorded_at.desc()).limit(1)
+    )).first()
     
     # Get recent anomalies (handle case where table might not exist)
-    # Get ALL anomalies for this patient, ordered by most recent
+    # Most recent first, capped - the full history lives on the anomalies page
     try:
-        recent_anomalies = Anomaly.query.filter_by(patient_id=user.id).order_by(Anomaly.detected_at.desc()).all()
+        recent_anomalies = db.session.scalars(lambda_stmt(
+            lambda: select(Anomaly).where(Anomaly.patient_id == patient_id)
+            .order_by(Anomaly.detected_at.desc()).limit(50)
+        )).all()
     except Exception:
         recent_anomalies = []
     
-    # Get unassigned anomalies (pending verification)
-    try:
-        unassigned_anomalies = Anomaly.query.filter_by(
-            patient_id=user.id,
-            case_status='pending'
-        ).order_by(Anomaly.detected_at.desc()).all()
-    except Exception:
-        unassigned_anomalies = []
-    
     # Get unread alerts
     try:
-        unread_alerts = Alert.query.filter_by(patient_id=user.id, is_read=False).order_by(Alert.created_at.desc()).limit(5).all()
+        unread_alerts = db.session.scalars(lambda_stmt(
+            lambda: select(Alert).where(
+                Alert.patient_id == patient_id, Alert.is_read == False
+            ).order_by(Alert.created_at.desc()).limit(5)
+        )).all()
     except Exception:
         unread_alerts = []
     
@@ -287,75 +711,35 @@ def patient_dashboard():
             if latest_vital.blood_pressure_systolic > 140 or latest_vital.blood_pressure_systolic < 90:
                 health_score -= 5
     
-    # Reduce health score based on anomalies
-    if recent_anomalies:
-        for anomaly in recent_anomalies:
-            if anomaly.severity == 'critical':
-                health_score -= 10
-            elif anomaly.severity == 'high':
-                health_score -= 5
-            elif anomaly.severity == 'medium':
-                health_score -= 2
-    
-    # Get vitals for consistency map (last 6 months, 1 per day for heatmap)
-    six_months_ago = datetime.utcnow() - timedelta(days=180)
-    daily_vitals = Vital.query.filter(
-        Vital.patient_id == user.id,
-        Vital.recorded_at >= six_months_ago
-    ).order_by(Vital.recorded_at.asc()).all()
-    
-    # Group by date and check for anomalies on each day
-    from collections import defaultdict
-    daily_anomaly_status = {}
+    # Anomaly-driven parts of the dashboard (score penalty, pending count, consistency map)
+    # come from one cached aggregate pass instead of separate queries per view
+    anomaly_penalty, pending_anomaly_count, daily_anomaly_status = get_anomaly_summary(user.id)
+    health_score -= anomaly_penalty
     
-    # Get anomalies grouped by date (use string keys for JSON serialization)
-    anomalies_by_date = defaultdict(list)
-    try:
-        for anomaly in Anomaly.query.filter_by(patient_id=user.id).all():
-            date_key = anomaly.detected_at.date().isoformat()  # Convert to string
-            anomalies_by_date[date_key].append(anomaly)
-    except Exception:
-        pass  # If Anomaly table doesn't exist yet, just skip
-    
-    # Mark days with anomalies
-    for date_key, anomalies in anomalies_by_date.items():
-        if anomalies:  # Check if list is not empty
-            max_severity = max([a.severity for a in anomalies], key=lambda x: ['low', 'medium', 'high', 'critical'].index(x))
-            daily_anomaly_status[date_key] = {
-                'has_anomaly': True,
-                'severity': max_severity
-            }
-    
-    # Prepare vitals data for charts (actual data from CSV)
-    vitals_chart_data = []
-    if recent_vitals_24h:
-        # Reverse to get chronological order (oldest first)
-        for vital in reversed(recent_vitals_24h):
-            vitals_chart_data.append({
-                'heart_rate': vital.heart_rate if vital.heart_rate else None,
-                'oxygen_saturation': vital.oxygen_saturation if vital.oxygen_saturation else None,
-                'timestamp': vital.recorded_at.strftime('%H:%M') if vital.recorded_at else None
-            })
+    # Vitals chart data (actual data from CSV), pre-serialized to JSON
+    vitals_chart_json = get_vitals_chart_json(user.id, latest_vital.id) if latest_vital else '[]'
     
     return render_template('patient/dashboard.html', 
                          user=user, 
                          latest_vital=latest_vital,
                          recent_anomalies=recent_anomalies,
-                         unassigned_anomalies=unassigned_anomalies,
+                         pending_anomaly_count=pending_anomaly_count,
                          unread_alerts=unread_alerts,
                          health_score=max(0, min(100, health_score)),
                          daily_anomaly_status=daily_anomaly_status,
-                         vitals_chart_data=vitals_chart_data,
+                         vitals_chart_json=vitals_chart_json,
                          page='dashboard')
 
 @app.route('/patient/anomalies')
 @patient_required
 def patient_anomalies():
-    user = User.query.get(session['user_id'])
+    user = current_user()
     
-    # Get all anomalies with pagination
+    # Get all anomalies, with their assigned doctors loaded up front for the template
     try:
-        anomalies = Anomaly.query.filter_by(patient_id=user.id).order_by(Anomaly.detected_at.desc()).all()
+        anomalies = Anomaly.query.options(selectinload(Anomaly.assigned_doctor)).filter_by(
+            patient_id=user.id
+        ).order_by(Anomaly.detected_at.desc()).all()
     except Exception:
         anomalies = []
     
@@ -367,8 +751,8 @@ def patient_anomalies():
 @app.route('/patient/anomaly/<int:anomaly_id>/consult-doctor')
 @patient_required
 def consult_doctor(anomaly_id):
-    user = User.query.get(session['user_id'])
-    anomaly = Anomaly.query.get_or_404(anomaly_id)
+    user = current_user()
+    anomaly = db.get_or_404(Anomaly, anomaly_id)
     
     # Verify anomaly belongs to patient
     if anomaly.patient_id != user.id:
@@ -376,7 +760,7 @@ def consult_doctor(anomaly_id):
         return redirect(url_for('patient_anomalies'))
     
     # Get all available doctors
-    all_doctors = User.query.filter_by(user_type='doctor').all()
+    all_doctors = get_doctor_directory()
     
     return render_template('patient/consult_doctor.html',
                          user=user,
@@ -387,9 +771,9 @@ def consult_doctor(anomaly_id):
 @app.route('/patient/anomaly/<int:anomaly_id>/assign-doctor/<int:doctor_id>', methods=['POST'])
 @patient_required
 def assign_anomaly_to_doctor(anomaly_id, doctor_id):
-    user = User.query.get(session['user_id'])
-    anomaly = Anomaly.query.get_or_404(anomaly_id)
-    doctor = User.query.get_or_404(doctor_id)
+    user = current_user()
+    anomaly = db.get_or_404(Anomaly, anomaly_id)
+    doctor = db.get_or_404(User, doctor_id)
     
     # Verify anomaly belongs to patient and doctor is valid
     if anomaly.patient_id != user.id:
@@ -403,77 +787,194 @@ def assign_anomaly_to_doctor(anomaly_id, doctor_id):
     anomaly.case_status = 'assigned'
     anomaly.assigned_at = datetime.utcnow()
     db.session.commit()
+    invalidate_dashboard(user.id)
     
     return jsonify({'status': 'success', 'message': f'Anomaly assigned to Dr. {doctor.first_name} {doctor.last_name}'})
 
+def map_vital_columns(columns):
+    """Map CSV column names to Vital fields - case-insensitive matching with normalization"""
+    normalized = [normalize_column_name(col) for col in columns]
+    mapped_columns = {}
+    for norm_col, col in zip(normalized, columns):
+        standard_name = VITAL_COLUMN_ALIASES.get(norm_col)
+        if standard_name and standard_name not in mapped_columns:
+            mapped_columns[standard_name] = col
+    return mapped_columns
+
+def read_vitals_csv(stream, encoding='utf-8'):
+    """Read a vitals CSV from a binary stream, parsing only the columns that map to Vital fields"""
+    # Read the header first, then parse only the mapped columns with explicit dtypes
+    stream.seek(0)
+    csv_columns = pd.read_csv(stream, nrows=0, encoding=encoding).columns
+    mapped_columns = map_vital_columns(csv_columns)
+    usecols = list(mapped_columns.values()) or None
+    dtype = {col: ('str' if field == 'energy_level' else 'float64') for field, col in mapped_columns.items()}
+    stream.seek(0)
+    if CSV_ENGINE == 'pyarrow':
+        try:
+            df = pd.read_csv(stream, usecols=usecols, dtype=dtype, encoding=encoding, engine='pyarrow')
+            return df, csv_columns, mapped_columns
+        except Exception:
+            # Bad cells or encoding - take the C parser path below, which handles both
+            stream.seek(0)
+    try:
+        df = pd.read_csv(stream, usecols=usecols, dtype=dtype, encoding=encoding, engine='c')
+    except UnicodeDecodeError:
+        raise
+    except ValueError:
+        # Non-numeric cells in a vitals column - let pandas infer and coerce later
+        stream.seek(0)
+        df = pd.read_csv(stream, usecols=usecols, encoding=encoding, engine='c')
+    return df, csv_columns, mapped_columns
+
+def create_prediction_anomalies(patient_id, healio_prediction):
+    """Raise anomalies and alerts for a model prediction (skipping types already raised in the last 24h); returns the anomaly count"""
+    anomalies_created = 0
+    try:
+        # One timestamp for the whole batch and its duplicate-check window
+        detected_at = datetime.utcnow()
+        cutoff_time = detected_at - timedelta(hours=24)
+        # Collected here and written in one batch after all checks
+        new_anomalies = []
+        new_alerts = []
+
+        risks = healio_prediction.get('risks', {})
+
+        # Look up which candidate anomaly types already exist in the window in one query
+        candidate_types = ['quantum_high_risk', 'quantum_early_warning'] + [f"quantum_{risk_key}_risk" for risk_key in risks]
+        existing_types = {
+            anomaly_type for (anomaly_type,) in db.session.query(Anomaly.anomaly_type).filter(
+                Anomaly.patient_id == patient_id,
+                Anomaly.anomaly_type.in_(candidate_types),
+                Anomaly.detected_at >= cutoff_time
+            )
+        }
+
+        # Overall alert level -> one anomaly plus alert (see PREDICTION_ALERT_RULES)
+        alert_rule = PREDICTION_ALERT_RULES.get(healio_prediction.get('alert', 'NORMAL'))
+        if alert_rule is not None and alert_rule[0] not in existing_types:
+            anomaly_type, severity, summary, alert_severity, alert_message = alert_rule
+            new_anomalies.append(Anomaly(
+                patient_id=patient_id,
+                anomaly_type=anomaly_type,
+                severity=severity,
+                description=f"{summary} by Quantum DL Model. Quantum score: {healio_prediction.get('quantum_score', 0):.4f}, Classical score: {healio_prediction.get('classical_score', 0):.4f}",
+                risk_score=float(healio_prediction.get('quantum_score', 0)),
+                detected_at=detected_at,
+                case_status='pending'
+            ))
+            new_alerts.append(Alert(
+                patient_id=patient_id,
+                alert_type=anomaly_type,
+                message=alert_message,
+                severity=alert_severity,
+                is_read=False
+            ))
+
+        # Create anomalies for individual disease risks above threshold (0.5),
+        # bucketing all risks into severities at once
+        risk_keys = list(risks)
+        risk_values = np.fromiter(risks.values(), dtype=np.float64, count=len(risk_keys))
+        severity_idx = np.digitize(risk_values, RISK_SEVERITY_BINS, right=True)
+        for idx in np.flatnonzero(risk_values > RISK_THRESHOLD):
+            risk_key, risk_value = risk_keys[idx], float(risk_values[idx])
+            anomaly_type = f"quantum_{risk_key}_risk"
+
+            # Check for duplicate
+            if anomaly_type in existing_types:
+                continue
+
+            disease_name = DISEASE_NAMES.get(risk_key, risk_key.title())
+            new_anomalies.append(Anomaly(
+                patient_id=patient_id,
+                anomaly_type=anomaly_type,
+                severity=RISK_SEVERITY_LABELS[severity_idx[idx]],
+                description=f"{disease_name} risk detected by Quantum DL Model. Risk probability: {risk_value:.1%}",
+                risk_score=risk_value,
+                detected_at=detected_at,
+                case_status='pending'
+            ))
+            alert_level = RISK_ALERT_LEVELS[severity_idx[idx]]
+            if alert_level is not None:
+                alert_severity, label = alert_level
+                new_alerts.append(Alert(
+                    patient_id=patient_id,
+                    alert_type='quantum_disease_risk',
+                    message=f"{disease_name} risk detected: {risk_value:.1%} probability ({label})",
+                    severity=alert_severity,
+                    is_read=False
+                ))
+
+        if new_anomalies or new_alerts:
+            db.session.bulk_save_objects(new_anomalies + new_alerts)
+            db.session.commit()
+            invalidate_dashboard(patient_id)
+            anomalies_created = len(new_anomalies)
+
+    except Exception as e:
+        logger.exception("[PREDICT] Error creating anomalies from Heal.io prediction: %s", e)
+        db.session.rollback()
+    return anomalies_created
+
+def run_prediction_job(prediction_id, patient_id, model_array):
+    """Background half of an upload: score the vitals, raise anomalies and fill in the pending Prediction row"""
+    with app.app_context():
+        prediction = db.session.get(Prediction, prediction_id)
+        try:
+            healio_prediction = app.config['PREDICT_BATCHER'].submit(model_array).result(timeout=app.config['PREDICT_TIMEOUT'])
+            logger.debug("[PREDICT] Model prediction: %s", healio_prediction)
+            anomalies_created = create_prediction_anomalies(patient_id, healio_prediction)
+            prediction.set_result(healio_prediction)
+            prediction.anomalies_created = anomalies_created
+            prediction.status = 'complete'
+            db.session.commit()
+        except Exception:
+            logger.exception("[PREDICT] Prediction job %s failed", prediction_id)
+            # Never leave the row pending - the upload page polls it until it settles
+            db.session.rollback()
+            prediction.status = 'failed'
+            db.session.commit()
+            return
+        
+        logger.info("[PREDICT] patient=%s prediction=%s alert=%s anomalies=%d", patient_id, prediction_id,
+                    healio_prediction.get('alert'), anomalies_created)
+
 @app.route('/patient/upload-vitals-csv', methods=['POST'])
 @patient_required
 def upload_vitals_csv():
     """Handle CSV upload for vitals data (3 days = 72 rows)"""
-    import traceback
-    
-    # CRITICAL: Force output immediately
-    sys.stdout.write("\n" + "=" * 80 + "\n")
-    sys.stdout.write("[UPLOAD] ========== CSV UPLOAD ROUTE CALLED ==========\n")
-    sys.stdout.write("=" * 80 + "\n")
-    sys.stdout.flush()
-    
-    logger.info("=" * 80)
-    logger.info("[UPLOAD] ========== CSV UPLOAD ROUTE CALLED ==========")
-    logger.info("=" * 80)
-    
-    # Also write to a log file to ensure we capture it
     try:
-        with open('upload_log.txt', 'a') as f:
-            f.write(f"\n[{datetime.utcnow()}] CSV UPLOAD ROUTE CALLED\n")
-            f.flush()
-    except:
-        pass
-    
-    try:
-        user = User.query.get(session['user_id'])
-        logger.info(f"[UPLOAD] User ID: {user.id if user else 'None'}")
-        logger.info(f"[UPLOAD] Request method: {request.method}")
-        logger.info(f"[UPLOAD] Request files: {list(request.files.keys())}")
-        print(f"[UPLOAD] User ID: {user.id if user else 'None'}", flush=True)
-        print(f"[UPLOAD] Request method: {request.method}", flush=True)
-        print(f"[UPLOAD] Request files: {list(request.files.keys())}", flush=True)
-        sys.stdout.flush()
+        user = current_user()
+        # Read the id once - each commit below expires the user, and touching it again would re-SELECT the row
+        patient_id = user.id
         
         # Clear existing anomalies for this patient before processing new data
         try:
-            Anomaly.query.filter_by(patient_id=user.id).delete()
+            Anomaly.query.filter_by(patient_id=patient_id).delete(synchronize_session=False)
             db.session.commit()
+            invalidate_dashboard(patient_id)
         except Exception as e:
-            print(f"Warning: Could not clear anomalies: {e}")
+            logger.warning("[UPLOAD] Could not clear anomalies: %s", e)
             db.session.rollback()
         
         if 'csv_file' not in request.files:
-            print("[UPLOAD ERROR] No file provided in request")
             return jsonify({'status': 'error', 'message': 'No file provided'}), 400
         
         file = request.files['csv_file']
-        print(f"[UPLOAD] File received: {file.filename}")
         if file.filename == '':
-            print("[UPLOAD ERROR] No file selected")
             return jsonify({'status': 'error', 'message': 'No file selected'}), 400
         
         if not file.filename.endswith('.csv'):
-            print("[UPLOAD ERROR] File is not a CSV")
             return jsonify({'status': 'error', 'message': 'File must be a CSV'}), 400
         
         # Read CSV file
         try:
-            print("[UPLOAD] Reading CSV file...")
-            file_content = file.stream.read()
-            # Try UTF-8 first, fallback to latin-1 if needed
+            # Parse the raw upload bytes directly - try UTF-8 first, fallback to latin-1 if needed
             try:
-                decoded_content = file_content.decode("UTF-8")
+                df, csv_columns, mapped_columns = read_vitals_csv(file.stream, encoding='utf-8')
             except UnicodeDecodeError:
-                decoded_content = file_content.decode("latin-1")
-            stream = io.StringIO(decoded_content, newline=None)
-            df = pd.read_csv(stream)
-            print(f"[UPLOAD] CSV read successfully. Shape: {df.shape}, Columns: {list(df.columns)}")
+                df, csv_columns, mapped_columns = read_vitals_csv(file.stream, encoding='latin-1')
+            logger.debug("[UPLOAD] CSV read successfully. Shape: %s", df.shape)
         except UnicodeDecodeError:
             return jsonify({'status': 'error', 'message': 'File encoding error. Please ensure the CSV file uses UTF-8 encoding'}), 400
         except pd.errors.EmptyDataError:
@@ -486,488 +987,113 @@ def upload_vitals_csv():
         if df.empty:
             return jsonify({'status': 'error', 'message': 'CSV file is empty'}), 400
         
-        # Normalize column names (handle various formats) - case-insensitive matching
-        column_mapping = {
-            'heart_rate': ['heart_rate', 'hr', 'heart rate', 'heartrate', 'pulse', 'bpm'],
-            'blood_pressure_systolic': ['blood_pressure_systolic', 'sbp', 'systolic', 'systolic_bp', 'systolic bp', 'bp_systolic', 'bp systolic', 'blood_pressure_sys'],
-            'blood_pressure_diastolic': ['blood_pressure_diastolic', 'dbp', 'diastolic', 'diastolic_bp', 'diastolic bp', 'bp_diastolic', 'bp diastolic', 'blood_pressure_dia'],
-            'oxygen_saturation': ['oxygen_saturation', 'spo2', 'sp_o2', 'oxygen', 'oxygen sat', 'o2_sat', 'o2 sat', 'saturation'],
-            'respiratory_rate': ['respiratory_rate', 'rr', 'respiratory rate', 'breathing_rate', 'breathing rate', 'respiration'],
-            'body_temperature': ['body_temperature', 'temp', 'temperature', 'body temp', 'body_temp', 'fever'],
-            'steps': ['steps', 'step_count', 'step count', 'walking_steps', 'walking steps'],
-            'sleep_hours': ['sleep_hours', 'sleep', 'sleep hours', 'sleep_hours', 'sleep_time', 'sleep time', 'sleep_duration', 'sleep duration'],
-            'energy_level': ['energy_level', 'energy', 'energy level', 'energy_lvl', 'vitality']
-        }
-        
-        # Map columns - case-insensitive matching with normalization
-        mapped_columns = {}
-        df.columns = df.columns.str.strip()  # Remove whitespace from column names
+        logger.debug("[UPLOAD] Column mapping result: %s", mapped_columns)
         
-        for standard_name, variants in column_mapping.items():
-            for col in df.columns:
-                col_normalized = col.strip().lower().replace(' ', '_').replace('-', '_')
-                variants_normalized = [v.lower().replace(' ', '_').replace('-', '_') for v in variants]
-                if col_normalized in variants_normalized or col.strip().lower() in [v.lower() for v in variants]:
-                    mapped_columns[standard_name] = col
-                    break
-        
-        print(f"[UPLOAD] CSV columns found: {list(df.columns)}")
-        print(f"[UPLOAD] Column mapping result: {mapped_columns}")
-        
-        # Log which columns were NOT mapped
-        unmapped_cols = [col for col in df.columns if col not in mapped_columns.values()]
+        # Log which columns were NOT mapped (set lookup instead of scanning dict values per column)
+        mapped_headers = frozenset(mapped_columns.values())
+        unmapped_cols = [col for col in csv_columns if col not in mapped_headers]
         if unmapped_cols:
-            print(f"[UPLOAD] WARNING: Unmapped columns found: {unmapped_cols}")
-            logger.warning(f"Unmapped columns: {unmapped_cols}")
+            logger.warning("[UPLOAD] Unmapped columns: %s", unmapped_cols)
         
         # Create vitals records - use entire dataset
         now = datetime.utcnow()
-        vitals_added = []
         total_rows = len(df)  # Process all rows from CSV
-        
-        for idx, row in df.iterrows():
-            
-            # Calculate timestamp - spread data over time (1 minute intervals)
-            # Start from (total_rows-1) minutes ago and go forward
-            minutes_ago = total_rows - 1 - idx
-            recorded_time = now - timedelta(minutes=minutes_ago)
-            
-            # Extract values with fallbacks - ensure ALL columns are stored
-            def safe_float(value):
-                """Safely convert to float"""
-                try:
-                    if pd.notna(value) and value != '':
-                        return float(value)
-                except (ValueError, TypeError):
-                    pass
-                return None
-            
-            def safe_int(value):
-                """Safely convert to int"""
-                try:
-                    if pd.notna(value) and value != '':
-                        return int(float(value))
-                except (ValueError, TypeError):
-                    pass
-                return None
-            
-            def safe_str(value):
-                """Safely convert to string"""
-                try:
-                    if pd.notna(value) and value != '':
-                        return str(value).strip()
-                except (ValueError, TypeError):
-                    pass
-                return None
-            
-            # Extract all vital signs - ALL columns must be stored
-            heart_rate = safe_float(row[mapped_columns['heart_rate']]) if 'heart_rate' in mapped_columns else None
-            blood_pressure_systolic = safe_float(row[mapped_columns['blood_pressure_systolic']]) if 'blood_pressure_systolic' in mapped_columns else None
-            blood_pressure_diastolic = safe_float(row[mapped_columns['blood_pressure_diastolic']]) if 'blood_pressure_diastolic' in mapped_columns else None
-            oxygen_saturation = safe_float(row[mapped_columns['oxygen_saturation']]) if 'oxygen_saturation' in mapped_columns else None
-            respiratory_rate = safe_float(row[mapped_columns['respiratory_rate']]) if 'respiratory_rate' in mapped_columns else None
-            body_temperature = safe_float(row[mapped_columns['body_temperature']]) if 'body_temperature' in mapped_columns else None
-            steps = safe_int(row[mapped_columns['steps']]) if 'steps' in mapped_columns else None
-            sleep_hours = safe_float(row[mapped_columns['sleep_hours']]) if 'sleep_hours' in mapped_columns else None
-            energy_level = safe_str(row[mapped_columns['energy_level']]) if 'energy_level' in mapped_columns else None
-            
-            # Log first row for debugging
-            if idx == 0:
-                print(f"[UPLOAD] First row sample - HR: {heart_rate}, SBP: {blood_pressure_systolic}, DBP: {blood_pressure_diastolic}, SpO2: {oxygen_saturation}, RR: {respiratory_rate}, Temp: {body_temperature}, Steps: {steps}, Sleep: {sleep_hours}")
-                logger.info(f"First row: HR={heart_rate}, SBP={blood_pressure_systolic}, DBP={blood_pressure_diastolic}, SpO2={oxygen_saturation}, RR={respiratory_rate}, Temp={body_temperature}, Steps={steps}, Sleep={sleep_hours}")
-            
-            # Create vital record - ALL fields must be stored
-            vital = Vital(
-                patient_id=user.id,
-                heart_rate=heart_rate,
-                blood_pressure_systolic=blood_pressure_systolic,
-                blood_pressure_diastolic=blood_pressure_diastolic,
-                oxygen_saturation=oxygen_saturation,
-                respiratory_rate=respiratory_rate,
-                body_temperature=body_temperature,
-                steps=steps,
-                sleep_hours=sleep_hours,
-                energy_level=energy_level,
-                recorded_at=recorded_time
-            )
-            
-            db.session.add(vital)
-            vitals_added.append(vital)
-            
-            # Log every 10th row for verification
-            if (idx + 1) % 10 == 0:
-                print(f"[UPLOAD] Processed {idx + 1}/{total_rows} rows - HR: {heart_rate}, SBP: {blood_pressure_systolic}, DBP: {blood_pressure_diastolic}, RR: {respiratory_rate}, Temp: {body_temperature}, Sleep: {sleep_hours}")
-        
-        # Commit all vitals
-        print(f"[UPLOAD] Committing {len(vitals_added)} vitals to database...")
+
+        # Extract all vital signs column-wise - ALL columns must be stored.
+        # Unparseable cells are coerced to NaN and stored as NULL.
+        # Numeric columns are coerced once here and reused for the model features below.
+        numeric_vitals = {
+            field: pd.to_numeric(df[column], errors='coerce')
+            for field, column in mapped_columns.items() if field != 'energy_level'
+        }
+        vitals_frame = {'patient_id': patient_id}
+        for field in ('heart_rate', 'blood_pressure_systolic', 'blood_pressure_diastolic',
+                      'oxygen_saturation', 'respiratory_rate', 'body_temperature', 'sleep_hours'):
+            vitals_frame[field] = numeric_vitals.get(field)
+        vitals_frame['steps'] = np.trunc(numeric_vitals['steps']).astype('Int64') if 'steps' in numeric_vitals else None
+        if 'energy_level' in mapped_columns:
+            energy = df[mapped_columns['energy_level']]
+            vitals_frame['energy_level'] = energy.astype(str).str.strip().where(energy.notna() & (energy != ''))
+        else:
+            vitals_frame['energy_level'] = None
+
+        # Spread data over time (1 minute intervals) - start from (total_rows-1) minutes ago and go forward
+        vitals_frame['recorded_at'] = pd.Timestamp(now) - pd.to_timedelta(np.arange(total_rows - 1, -1, -1), unit='m')
+
+        vitals_frame = pd.DataFrame(vitals_frame, index=df.index)
+        vitals_frame = vitals_frame.astype(object).where(vitals_frame.notna(), None)
+        records = vitals_frame.to_dict(orient='records')
+
+        if records:
+            logger.debug("[UPLOAD] First row sample: %s", records[0])
+
+        # Insert all vitals in a single Core executemany - the rows are already
+        # plain column dicts, so the ORM's bulk bookkeeping is skipped
+        db.session.execute(Vital.__table__.insert(), records)
         db.session.commit()
-        print(f"[UPLOAD] Vitals committed successfully")
         
-        # Run Heal.io Quantum DL Model Prediction
-        print("[UPLOAD] ========== STARTING MODEL PREDICTION ==========", flush=True)
-        logger.info("========== STARTING MODEL PREDICTION ==========")
-        healio_prediction = None
+        # Run Heal.io Quantum DL Model Prediction in the background - the client polls prediction_url
+        prediction_id = None
         
-        # FORCE MODEL EXECUTION - Always try to run the model
-        print("[UPLOAD] Step 1: Importing healio_model...", flush=True)
-        logger.info("Step 1: Importing healio_model...")
-        sys.stdout.flush()
+        # Shared micro-batcher set up at startup (see PREDICT_BATCHER)
+        predict_batcher = app.config.get('PREDICT_BATCHER')
         
-        # Get the model function - module should already be imported at startup
-        try:
-            print("[UPLOAD] Getting predict_from_csv from pre-imported module...", flush=True)
-            logger.info("Getting predict_from_csv from pre-imported module...")
-            sys.stdout.flush()
-            
-            # Use the pre-imported module
-            import healio_model
-            if hasattr(healio_model, 'predict_from_csv'):
-                predict_from_csv = healio_model.predict_from_csv
-                print(f"[UPLOAD] Function retrieved: {predict_from_csv}", flush=True)
-                logger.info(f"Function retrieved: {predict_from_csv}")
-            else:
-                print("[ERROR] predict_from_csv function not found in module", flush=True)
-                logger.error("predict_from_csv function not found in module")
-                predict_from_csv = None
-                
-        except Exception as import_err:
-            print(f"[ERROR] ========== IMPORT ERROR ==========", flush=True)
-            print(f"[ERROR] Cannot get predict_from_csv: {import_err}", flush=True)
-            logger.error(f"Import error: {import_err}")
-            traceback.print_exc()
-            print(f"[ERROR] ==================================", flush=True)
-            sys.stdout.flush()
-            predict_from_csv = None
-        
-        if predict_from_csv is not None and callable(predict_from_csv):
-            print(f"[UPLOAD] predict_from_csv is available and callable", flush=True)
-            logger.info("predict_from_csv is available and callable")
-            print(f"[UPLOAD] Step 2: Preparing model data. CSV has {len(df)} rows", flush=True)
-            logger.info(f"Step 2: Preparing model data. CSV has {len(df)} rows")
-            print(f"[UPLOAD] Mapped columns: {mapped_columns}", flush=True)
-            logger.info(f"Mapped columns: {mapped_columns}")
-            sys.stdout.flush()
-            
+        if predict_batcher is not None:
             # Prepare data for model: extract the 5 required features
             # heart_rate, sbp, dbp, spo2, sleep_state
-            model_data = []
-            print("[UPLOAD] Step 3: Extracting features from CSV...", flush=True)
-            logger.info("Step 3: Extracting features from CSV...")
-            sys.stdout.flush()
-            
-            row_count = 0
-            for idx, row in df.iterrows():
-                row_count += 1
-                # Get heart_rate
-                hr = 72  # default
-                if 'heart_rate' in mapped_columns:
-                    try:
-                        hr = float(row[mapped_columns['heart_rate']]) if pd.notna(row[mapped_columns['heart_rate']]) else 72
-                    except:
-                        pass
-                
-                # Get sbp (systolic blood pressure)
-                sbp = 120  # default
-                if 'blood_pressure_systolic' in mapped_columns:
-                    try:
-                        sbp = float(row[mapped_columns['blood_pressure_systolic']]) if pd.notna(row[mapped_columns['blood_pressure_systolic']]) else 120
-                    except:
-                        pass
-                
-                # Get dbp (diastolic blood pressure)
-                dbp = 80  # default
-                if 'blood_pressure_diastolic' in mapped_columns:
-                    try:
-                        dbp = float(row[mapped_columns['blood_pressure_diastolic']]) if pd.notna(row[mapped_columns['blood_pressure_diastolic']]) else 80
-                    except:
-                        pass
-                
-                # Get spo2 (oxygen saturation)
-                spo2 = 98  # default
-                if 'oxygen_saturation' in mapped_columns:
-                    try:
-                        spo2 = float(row[mapped_columns['oxygen_saturation']]) if pd.notna(row[mapped_columns['oxygen_saturation']]) else 98
-                    except:
-                        pass
-                
-                # Map sleep_hours to sleep_state (0=awake, 1=light, 2=deep, 3=REM)
-                sleep_state = 0
-                if 'sleep_hours' in mapped_columns:
-                    try:
-                        sleep_hrs = float(row[mapped_columns['sleep_hours']]) if pd.notna(row[mapped_columns['sleep_hours']]) else 0
-                        if sleep_hrs > 0.5:
-                            sleep_state = 2  # Deep sleep
-                        elif sleep_hrs > 0.25:
-                            sleep_state = 1  # Light sleep
-                        elif sleep_hrs > 0:
-                            sleep_state = 3  # REM
-                    except:
-                        sleep_state = 0
-                
-                model_data.append([hr, sbp, dbp, spo2, sleep_state])
-            
-            print(f"[UPLOAD] Step 4: Converted {len(model_data)} rows to model format", flush=True)
-            logger.info(f"Step 4: Converted {len(model_data)} rows to model format")
-            sys.stdout.flush()
             
-            # Convert to numpy array
-            model_array = np.array(model_data)
-            print(f"[UPLOAD] Step 5: Model data shape: {model_array.shape}", flush=True)
-            logger.info(f"Step 5: Model data shape: {model_array.shape}")
-            print(f"[UPLOAD] First 3 rows: {model_array[:3].tolist() if len(model_array) >= 3 else model_array.tolist()}", flush=True)
-            sys.stdout.flush()
+            # Write each feature straight into a preallocated float32 buffer.
+            # Missing columns and unparseable cells fall back to resting defaults
+            model_array = np.empty((total_rows, len(MODEL_FEATURE_DEFAULTS)), dtype=np.float32)
+            for col_idx, (field, default) in enumerate(MODEL_FEATURE_DEFAULTS.items()):
+                if field in numeric_vitals:
+                    model_array[:, col_idx] = numeric_vitals[field].fillna(default).to_numpy()
+                else:
+                    model_array[:, col_idx] = default
             
-            # Run prediction - THIS IS THE CRITICAL CALL
-            print(f"[UPLOAD] Step 6: CALLING predict_from_csv() NOW...", flush=True)
-            print(f"[UPLOAD] Array shape being passed: {model_array.shape}", flush=True)
-            print(f"[UPLOAD] Array dtype: {model_array.dtype}", flush=True)
-            print(f"[UPLOAD] Array sample (first row): {model_array[0] if len(model_array) > 0 else 'EMPTY'}", flush=True)
-            sys.stdout.flush()
+            # Map sleep_hours to sleep_state (0=awake, 1=light, 2=deep, 3=REM)
+            model_array[:, 4] = SLEEP_STATE_CODES[np.searchsorted(SLEEP_STATE_EDGES, model_array[:, 4], side='left')]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[UPLOAD] Model input shape %s, first row %s", model_array.shape, model_array[:1].tolist())
             
-            try:
-                # Write to log file
-                try:
-                    with open('upload_log.txt', 'a') as f:
-                        f.write(f"[{datetime.utcnow()}] About to call predict_from_csv with shape {model_array.shape}\n")
-                        f.flush()
-                except:
-                    pass
-                
-                print(f"[UPLOAD] About to call predict_from_csv...", flush=True)
-                logger.info("About to call predict_from_csv...")
-                logger.info(f"Array shape: {model_array.shape}, dtype: {model_array.dtype}")
-                sys.stdout.write(f"[UPLOAD] CALLING predict_from_csv NOW with shape {model_array.shape}\n")
-                sys.stdout.flush()
-                
-                # ACTUALLY CALL THE FUNCTION - THIS IS THE CRITICAL LINE
-                healio_prediction = predict_from_csv(model_array)
-                
-                # Write success to log file
-                try:
-                    with open('upload_log.txt', 'a') as f:
-                        f.write(f"[{datetime.utcnow()}] predict_from_csv completed successfully\n")
-                        f.write(f"Result: {healio_prediction}\n")
-                        f.flush()
-                except:
-                    pass
-                
-                print(f"[UPLOAD] MODEL PREDICTION SUCCESSFUL", flush=True)
-                logger.info("MODEL PREDICTION SUCCESSFUL")
-                print(f"[UPLOAD] Prediction result type: {type(healio_prediction)}", flush=True)
-                logger.info(f"Prediction result type: {type(healio_prediction)}")
-                print(f"[UPLOAD] Prediction result: {healio_prediction}", flush=True)
-                logger.info(f"Prediction result: {healio_prediction}")
-                sys.stdout.flush()
-                
-                # Store prediction in session for display
-                session['latest_healio_prediction'] = healio_prediction
-                session.permanent = True  # Make session persistent
-                print(f"[UPLOAD] ✓ Prediction stored in session", flush=True)
-                print(f"[UPLOAD] Scores - Quantum: {healio_prediction.get('quantum_score', 'N/A')}, Classical: {healio_prediction.get('classical_score', 'N/A')}", flush=True)
-            except Exception as model_error:
-                print(f"[ERROR] ========== MODEL EXECUTION ERROR ==========", flush=True)
-                print(f"[ERROR] Error during predict_from_csv call: {model_error}", flush=True)
-                print(f"[ERROR] Error type: {type(model_error).__name__}", flush=True)
-                traceback.print_exc()
-                print(f"[ERROR] ===========================================", flush=True)
-                sys.stdout.flush()
-                healio_prediction = None
+            # Queue the job against a pending row; only its id goes into the session cookie
+            prediction = Prediction(patient_id=patient_id)
+            db.session.add(prediction)
+            db.session.flush()
+            prediction_id = prediction.id
+            db.session.commit()
+            session['latest_prediction_id'] = prediction_id
+            _prediction_jobs.submit(run_prediction_job, prediction_id, patient_id, model_array)
         else:
-            print("[ERROR] predict_from_csv function not available - import failed", flush=True)
-            logger.error("predict_from_csv function not available - import failed")
-            print(f"[ERROR] predict_from_csv value: {predict_from_csv}", flush=True)
-            logger.error(f"predict_from_csv value: {predict_from_csv}")
-            sys.stdout.flush()
-        
-        print("[UPLOAD] ========== MODEL PREDICTION SECTION COMPLETE ==========", flush=True)
-        print(f"[UPLOAD] Final healio_prediction status: {healio_prediction is not None}", flush=True)
-        sys.stdout.flush()
-        
-        # Create anomalies and alerts based on Heal.io Quantum DL Model prediction
-        anomalies_created = 0
-        if healio_prediction:
-            try:
-                cutoff_time = datetime.utcnow() - timedelta(hours=24)
-                
-                # Map alert level to severity
-                alert = healio_prediction.get('alert', 'NORMAL')
-                if alert == 'HIGH RISK':
-                    # Create anomaly for high risk detection
-                    anomaly_type = 'quantum_high_risk'
-                    existing = Anomaly.query.filter(
-                        Anomaly.patient_id == user.id,
-                        Anomaly.anomaly_type == anomaly_type,
-                        Anomaly.detected_at >= cutoff_time
-                    ).first()
-                    
-                    if not existing:
-                        anomaly = Anomaly(
-                            patient_id=user.id,
-                            anomaly_type=anomaly_type,
-                            severity='high',
-                            description=f"High risk detected by Quantum DL Model. Quantum score: {healio_prediction.get('quantum_score', 0):.4f}, Classical score: {healio_prediction.get('classical_score', 0):.4f}",
-                            risk_score=float(healio_prediction.get('quantum_score', 0)),
-                            detected_at=datetime.utcnow(),
-                            case_status='pending'
-                        )
-                        db.session.add(anomaly)
-                        anomalies_created += 1
-                        
-                        # Create alert
-                        alert_obj = Alert(
-                            patient_id=user.id,
-                            alert_type='quantum_high_risk',
-                            message=f"HIGH RISK detected by Quantum DL Model. Immediate attention recommended.",
-                            severity='critical',
-                            is_read=False
-                        )
-                        db.session.add(alert_obj)
-                
-                elif alert == 'EARLY WARNING':
-                    # Create anomaly for early warning
-                    anomaly_type = 'quantum_early_warning'
-                    existing = Anomaly.query.filter(
-                        Anomaly.patient_id == user.id,
-                        Anomaly.anomaly_type == anomaly_type,
-                        Anomaly.detected_at >= cutoff_time
-                    ).first()
-                    
-                    if not existing:
-                        anomaly = Anomaly(
-                            patient_id=user.id,
-                            anomaly_type=anomaly_type,
-                            severity='medium',
-                            description=f"Early warning detected by Quantum DL Model. Quantum score: {healio_prediction.get('quantum_score', 0):.4f}, Classical score: {healio_prediction.get('classical_score', 0):.4f}",
-                            risk_score=float(healio_prediction.get('quantum_score', 0)),
-                            detected_at=datetime.utcnow(),
-                            case_status='pending'
-                        )
-                        db.session.add(anomaly)
-                        anomalies_created += 1
-                        
-                        # Create alert
-                        alert_obj = Alert(
-                            patient_id=user.id,
-                            alert_type='quantum_early_warning',
-                            message=f"Early warning detected by Quantum DL Model. Monitor closely.",
-                            severity='high',
-                            is_read=False
-                        )
-                        db.session.add(alert_obj)
-                
-                # Create anomalies for individual disease risks if above threshold (0.5)
-                risks = healio_prediction.get('risks', {})
-                risk_threshold = 0.5
-                
-                disease_mapping = {
-                    'cardio': 'Cardiovascular',
-                    'respiratory': 'Respiratory',
-                    'metabolic': 'Metabolic',
-                    'neurological': 'Neurological'
-                }
-                
-                for risk_key, risk_value in risks.items():
-                    if risk_value > risk_threshold:
-                        disease_name = disease_mapping.get(risk_key, risk_key.title())
-                        anomaly_type = f"quantum_{risk_key}_risk"
-                        
-                        # Check for duplicate
-                        existing = Anomaly.query.filter(
-                            Anomaly.patient_id == user.id,
-                            Anomaly.anomaly_type == anomaly_type,
-                            Anomaly.detected_at >= cutoff_time
-                        ).first()
-                        
-                        if not existing:
-                            # Determine severity based on risk value
-                            if risk_value > 0.7:
-                                severity = 'high'
-                            elif risk_value > 0.5:
-                                severity = 'medium'
-                            else:
-                                severity = 'low'
-                            
-                            anomaly = Anomaly(
-                                patient_id=user.id,
-                                anomaly_type=anomaly_type,
-                                severity=severity,
-                                description=f"{disease_name} risk detected by Quantum DL Model. Risk probability: {risk_value:.1%}",
-                                risk_score=float(risk_value),
-                                detected_at=datetime.utcnow(),
-                                case_status='pending'
-                            )
-                            db.session.add(anomaly)
-                            anomalies_created += 1
-                            
-                            # Create alert for high risk diseases
-                            if risk_value > 0.7:
-                                alert_obj = Alert(
-                                    patient_id=user.id,
-                                    alert_type='quantum_disease_risk',
-                                    message=f"{disease_name} risk detected: {risk_value:.1%} probability (High)",
-                                    severity='critical',
-                                    is_read=False
-                                )
-                                db.session.add(alert_obj)
-                            elif risk_value > 0.5:
-                                alert_obj = Alert(
-                                    patient_id=user.id,
-                                    alert_type='quantum_disease_risk',
-                                    message=f"{disease_name} risk detected: {risk_value:.1%} probability (Moderate)",
-                                    severity='high',
-                                    is_read=False
-                                )
-                                db.session.add(alert_obj)
-                
-                if anomalies_created > 0:
-                    db.session.commit()
-                    
-            except Exception as e:
-                print(f"Error creating anomalies from Heal.io prediction: {e}")
-                import traceback
-                traceback.print_exc()
-                db.session.rollback()
+            logger.error("[UPLOAD] predict_from_csv function not available - import failed")
         
         response_data = {
             'status': 'success',
-            'count': len(vitals_added),
-            'anomalies_created': anomalies_created,
-            'message': f'Successfully uploaded {len(vitals_added)} vital records. {anomalies_created} anomaly/anomalies detected.' if anomalies_created > 0 else f'Successfully uploaded {len(vitals_added)} vital records.'
+            'count': len(records),
+            'message': f'Successfully uploaded {len(records)} vital records.'
         }
         
-        # Add Heal.io prediction results if available
-        if healio_prediction:
-            print(f"[UPLOAD] Adding prediction to response: {healio_prediction}")
-            response_data['healio_prediction'] = healio_prediction
-        else:
-            print("[UPLOAD] WARNING: No prediction result available")
+        # Point the client at the background prediction, if one was queued
+        if prediction_id is not None:
+            response_data['prediction_id'] = prediction_id
+            response_data['prediction_url'] = url_for('patient_prediction', prediction_id=prediction_id)
         
-        print(f"[UPLOAD] Returning response: {response_data.get('status')}, count: {response_data.get('count')}, has_prediction: {healio_prediction is not None}")
-        print("=" * 80)
-        return jsonify(response_data)
+        # One summary line per upload; per-phase detail is logged at DEBUG
+        logger.info("[UPLOAD] patient=%s rows=%d prediction=%s", patient_id, len(records), prediction_id)
+        return jsonify(response_data), 202 if prediction_id is not None else 200
         
     except pd.errors.EmptyDataError:
         db.session.rollback()
-        print("[ERROR] Empty CSV file", flush=True)
-        sys.stdout.flush()
         return jsonify({'status': 'error', 'message': 'CSV file is empty or invalid'}), 400
     except pd.errors.ParserError as e:
         db.session.rollback()
-        print(f"[ERROR] CSV parse error: {e}", flush=True)
-        sys.stdout.flush()
         return jsonify({'status': 'error', 'message': f'Invalid CSV format: {str(e)}'}), 400
     except UnicodeDecodeError:
         db.session.rollback()
-        print("[ERROR] Unicode decode error", flush=True)
-        sys.stdout.flush()
         return jsonify({'status': 'error', 'message': 'File encoding error. Please ensure the CSV file uses UTF-8 encoding'}), 400
     except Exception as e:
         db.session.rollback()
-        error_trace = traceback.format_exc()
-        print(f"[ERROR] ========== UNEXPECTED ERROR IN UPLOAD ==========", flush=True)
-        print(f"Error in upload_vitals_csv: {error_trace}", flush=True)
-        print(f"[ERROR] =================================================", flush=True)
-        sys.stdout.flush()
+        logger.exception("[UPLOAD] Unexpected error in upload_vitals_csv")
         # Return user-friendly error message
         error_message = str(e)
         if "No module named" in error_message or "cannot import" in error_message.lower():
@@ -976,23 +1102,24 @@ def upload_vitals_csv():
             error_message = "An error occurred while processing the file. Please check the CSV format."
         return jsonify({'status': 'error', 'message': error_message}), 500
 
-@app.route('/patient/vitals')
+@app.route('/patient/prediction/<int:prediction_id>')
 @patient_required
-def patient_vitals():
-    user = User.query.get(session['user_id'])
-    
-    # Get current vitals
-    current_vital = Vital.query.filter_by(patient_id=user.id).order_by(Vital.recorded_at.desc()).first()
-    
-    # Get latest Heal.io prediction from session (stored during upload)
-    healio_prediction = session.get('latest_healio_prediction', None)
-    
-    # Get date range from query parameters
-    from_date = request.args.get('from_date')
-    to_date = request.args.get('to_date')
-    
+def patient_prediction(prediction_id):
+    """Poll the background prediction queued by an upload"""
+    user = current_user()
+    prediction = db.session.get(Prediction, prediction_id)
+    if prediction is None or prediction.patient_id != user.id:
+        return jsonify({'status': 'error', 'message': 'Prediction not found'}), 404
+    
+    response_data = {'status': prediction.status, 'anomalies_created': prediction.anomalies_created or 0}
+    if prediction.status == 'complete':
+        response_data['healio_prediction'] = prediction.to_dict()
+    return jsonify(response_data)
+
+def build_vitals_chart_data(patient_id, from_date, to_date):
+    """Chart series for the vitals page over the requested date range (default: the last year)"""
     # Build query for vitals
-    query = Vital.query.filter_by(patient_id=user.id)
+    query = Vital.query.filter_by(patient_id=patient_id)
     
     # Apply date filters if provided
     if from_date:
@@ -1022,35 +1149,75 @@ def patient_vitals():
         one_year_ago = datetime.utcnow() - timedelta(days=365)
         query = query.filter(Vital.recorded_at >= one_year_ago)
     
-    # Get vitals for visualization
-    yearly_vitals = query.order_by(Vital.recorded_at.asc()).all()
+    # Get vitals for visualization - read the Core statement straight into a DataFrame, no ORM objects
+    vitals_stmt = query.with_entities(
+        Vital.recorded_at, *(column.label(key) for key, column in CHART_VITAL_COLUMNS.items())
+    ).order_by(Vital.recorded_at.asc()).statement
+    vitals_df = pd.read_sql(vitals_stmt, db.session.connection(), parse_dates=['recorded_at'], dtype={'steps': 'Int64'})
     
-    # Prepare data for charts - include all vital metrics (aligned with dates)
-    vitals_data = {
-        'dates': [v.recorded_at.strftime('%Y-%m-%d %H:%M') for v in yearly_vitals],
-        'heart_rate': [v.heart_rate if v.heart_rate else None for v in yearly_vitals],
-        'oxygen_saturation': [v.oxygen_saturation if v.oxygen_saturation else None for v in yearly_vitals],
-        'blood_pressure_systolic': [v.blood_pressure_systolic if v.blood_pressure_systolic else None for v in yearly_vitals],
-        'blood_pressure_diastolic': [v.blood_pressure_diastolic if v.blood_pressure_diastolic else None for v in yearly_vitals],
-        'respiratory_rate': [v.respiratory_rate if v.respiratory_rate else None for v in yearly_vitals],
-        'temperature': [v.body_temperature if v.body_temperature else None for v in yearly_vitals],
-        'steps': [v.steps if v.steps else None for v in yearly_vitals],
-        'sleep_hours': [v.sleep_hours if v.sleep_hours else None for v in yearly_vitals]
-    }
+    # Prepare data for charts - include all vital metrics (aligned with dates); missing or zero readings become gaps
+    series = vitals_df[list(CHART_VITAL_COLUMNS)]
+    vitals_data = {'dates': vitals_df['recorded_at'].dt.strftime('%Y-%m-%d %H:%M').tolist()}
+    vitals_data.update(series.astype(object).where(series.notna() & series.ne(0), None).to_dict(orient='list'))
+    
+    return vitals_data
+
+@app.route('/patient/vitals')
+@patient_required
+def patient_vitals():
+    user = current_user()
+    
+    # Get current vitals
+    current_vital = Vital.query.filter_by(patient_id=user.id).order_by(Vital.recorded_at.desc()).first()
+    
+    # Get latest Heal.io prediction (its id is stored in the session during upload)
+    healio_prediction = None
+    prediction_id = session.get('latest_prediction_id')
+    if prediction_id is not None:
+        prediction = db.session.get(Prediction, prediction_id)
+        if prediction is not None and prediction.patient_id == user.id and prediction.status == 'complete':
+            healio_prediction = prediction.to_dict()
+    
+    # Get date range from query parameters
+    from_date = request.args.get('from_date')
+    to_date = request.args.get('to_date')
     
-    return render_template('patient/vitals.html', 
+    # Revalidate with an ETag over everything the page depends on: a new upload always changes the
+    # latest vital, and the default one-year window moves with the date. Skip it while flashes are pending.
+    data_version = (current_vital.id if current_vital else None, datetime.utcnow().date())
+    etag = hashlib.sha1(repr((user.id, from_date, to_date, data_version, prediction_id, healio_prediction is not None)).encode()).hexdigest()
+    if etag in request.if_none_match and '_flashes' not in session:
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    # Chart series are reused until a newer vital arrives (or the day rolls over)
+    cache_key = ('vitals', user.id, from_date, to_date)
+    with _cache_lock:
+        cached = _dashboard_cache.get(cache_key)
+    if cached is not None and cached[0] == data_version:
+        vitals_data = cached[1]
+    else:
+        vitals_data = build_vitals_chart_data(user.id, from_date, to_date)
+        with _cache_lock:
+            _dashboard_cache[cache_key] = (data_version, vitals_data)
+    
+    response = make_response(render_template('patient/vitals.html', 
                          user=user,
                          current_vital=current_vital,
                          vitals_data=vitals_data,
                          from_date=from_date,
                          to_date=to_date,
                          healio_prediction=healio_prediction,
-                         page='vitals')
+                         page='vitals'))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/patient/doctors')
 @patient_required
 def patient_doctors():
-    user = User.query.get(session['user_id'])
+    user = current_user()
     
     # Get connected doctors
     connected_doctors = PatientDoctor.query.filter_by(
@@ -1065,7 +1232,7 @@ def patient_doctors():
     ).all()
     
     # Get all available doctors
-    all_doctors = User.query.filter_by(user_type='doctor').all()
+    all_doctors = get_doctor_directory()
     connected_doctor_ids = [rel.doctor_id for rel in connected_doctors]
     available_doctors = [d for d in all_doctors if d.id not in connected_doctor_ids]
     
@@ -1079,8 +1246,8 @@ def patient_doctors():
 @app.route('/patient/request_doctor/<int:doctor_id>', methods=['POST'])
 @patient_required
 def request_doctor(doctor_id):
-    user = User.query.get(session['user_id'])
-    doctor = User.query.get(doctor_id)
+    user = current_user()
+    doctor = db.session.get(User, doctor_id)
     
     if not doctor or doctor.user_type != 'doctor':
         flash('Invalid doctor.', 'error')
@@ -1111,7 +1278,7 @@ def request_doctor(doctor_id):
 @app.route('/doctor/dashboard')
 @doctor_required
 def doctor_dashboard():
-    user = User.query.get(session['user_id'])
+    user = current_user()
     
     # Get pending patient requests
     pending_requests = PatientDoctor.query.filter_by(
@@ -1131,33 +1298,8 @@ def doctor_dashboard():
     except Exception:
         assigned_cases = []
     
-    # Get all assigned cases for consistency map
-    try:
-        all_assigned_cases = Anomaly.query.filter_by(assigned_doctor_id=user.id).all()
-    except Exception:
-        all_assigned_cases = []
-    
-    # Group anomalies by date for consistency map
-    from collections import defaultdict
-    daily_anomaly_status = {}
-    anomalies_by_date = defaultdict(list)
-    
-    try:
-        for case in all_assigned_cases:
-            date_key = case.detected_at.date().isoformat()
-            anomalies_by_date[date_key].append(case)
-        
-        # Mark days with anomalies
-        for date_key, anomalies in anomalies_by_date.items():
-            if anomalies:
-                max_severity = max([a.severity for a in anomalies], key=lambda x: ['low', 'medium', 'high', 'critical'].index(x))
-                daily_anomaly_status[date_key] = {
-                    'has_anomaly': True,
-                    'severity': max_severity,
-                    'count': len(anomalies)
-                }
-    except Exception:
-        pass
+    # Highest severity and case count per day for the consistency map
+    daily_anomaly_status = daily_anomaly_map(Anomaly.assigned_doctor_id == user.id, with_count=True)
     
     return render_template('doctor/dashboard.html', 
                          user=user,
@@ -1170,7 +1312,7 @@ def doctor_dashboard():
 @app.route('/doctor/patients')
 @doctor_required
 def doctor_patients():
-    user = User.query.get(session['user_id'])
+    user = current_user()
     
     # Get all accepted patients
     relationships = PatientDoctor.query.filter_by(
@@ -1188,10 +1330,10 @@ def doctor_patients():
 @app.route('/doctor/patient/<int:patient_id>')
 @doctor_required
 def doctor_patient_detail(patient_id):
-    user = User.query.get(session['user_id'])
+    user = current_user()
     
-    # Verify doctor has access to this patient
-    relationship = PatientDoctor.query.filter_by(
+    # Verify doctor has access to this patient, loading the patient with the relationship
+    relationship = PatientDoctor.query.options(joinedload(PatientDoctor.patient)).filter_by(
         doctor_id=user.id,
         patient_id=patient_id,
         status='accepted'
@@ -1201,26 +1343,21 @@ def doctor_patient_detail(patient_id):
         flash('Access denied.', 'error')
         return redirect(url_for('doctor_patients'))
     
-    patient = User.query.get(patient_id)
-    
-    # Get current vitals
-    current_vital = Vital.query.filter_by(patient_id=patient_id).order_by(Vital.recorded_at.desc()).first()
+    patient = relationship.patient
     
-    # Get recent vitals for graph
-    recent_vitals = Vital.query.filter_by(patient_id=patient_id).order_by(Vital.recorded_at.desc()).limit(30).all()
+    # Get recent vitals for graph (newest 30, in chronological order) - the last one
+    # is the current vital, so it doesn't need a query of its own
+    recent_vitals = latest_vitals_ascending(Vital.patient_id == patient_id)
+    current_vital = recent_vitals[-1] if recent_vitals else None
     
     # Prepare vitals data for charts - include all vital metrics
-    vitals_data = {
-        'dates': [v.recorded_at.strftime('%Y-%m-%d %H:%M') for v in reversed(recent_vitals)],
-        'heart_rate': [v.heart_rate for v in reversed(recent_vitals) if v.heart_rate],
-        'oxygen_saturation': [v.oxygen_saturation for v in reversed(recent_vitals) if v.oxygen_saturation],
-        'blood_pressure_systolic': [v.blood_pressure_systolic for v in reversed(recent_vitals) if v.blood_pressure_systolic],
-        'blood_pressure_diastolic': [v.blood_pressure_diastolic for v in reversed(recent_vitals) if v.blood_pressure_diastolic],
-        'respiratory_rate': [v.respiratory_rate for v in reversed(recent_vitals) if v.respiratory_rate],
-        'temperature': [v.body_temperature for v in reversed(recent_vitals) if v.body_temperature],
-        'steps': [v.steps for v in reversed(recent_vitals) if v.steps],
-        'sleep_hours': [v.sleep_hours for v in reversed(recent_vitals) if v.sleep_hours]
-    }
+    dates, series = transpose_vital_rows([
+        (vital.recorded_at, *(getattr(vital, column.key) for column in CHART_VITAL_COLUMNS.values()))
+        for vital in recent_vitals
+    ])
+    vitals_data = {'dates': dates}
+    for key, values in series.items():
+        vitals_data[key] = [value for value in values if value]
     
     return render_template('doctor/patient_detail.html', 
                          user=user,
@@ -1232,7 +1369,7 @@ def doctor_patient_detail(patient_id):
 @app.route('/doctor/cases')
 @doctor_required
 def doctor_cases():
-    user = User.query.get(session['user_id'])
+    user = current_user()
     
     # Get assigned anomalies
     try:
@@ -1248,28 +1385,20 @@ def doctor_cases():
 @app.route('/doctor/case/<int:anomaly_id>')
 @doctor_required
 def doctor_view_case(anomaly_id):
-    user = User.query.get(session['user_id'])
-    anomaly = Anomaly.query.get_or_404(anomaly_id)
+    user = current_user()
+    # Load the case together with its patient
+    anomaly = Anomaly.query.options(joinedload(Anomaly.patient)).filter(Anomaly.id == anomaly_id).first_or_404()
     
     # Verify doctor is assigned to this anomaly
     if anomaly.assigned_doctor_id != user.id:
         flash('Unauthorized access.', 'error')
         return redirect(url_for('doctor_cases'))
     
-    patient = User.query.get(anomaly.patient_id)
+    patient = anomaly.patient
     
-    # Get vitals related to this case - last 30 records only
-    # Get the most recent 30 vitals before and up to the anomaly detection time
-    related_vitals = Vital.query.filter(
-        Vital.patient_id == anomaly.patient_id,
-        Vital.recorded_at <= anomaly.detected_at
-    ).order_by(Vital.recorded_at.desc()).limit(30).all()
-    
-    # Reverse to get chronological order (oldest first)
-    related_vitals = list(reversed(related_vitals))
-    
-    # Get latest vital for current metrics display
-    latest_vital = Vital.query.filter_by(patient_id=anomaly.patient_id).order_by(Vital.recorded_at.desc()).first()
+    # Get the most recent 30 vitals up to the anomaly detection time (oldest first),
+    # plus the latest vital for current metrics display
+    related_vitals, latest_vital = get_case_vitals(anomaly.patient_id, anomaly.detected_at)
     
     # Prepare vitals data for charts
     vitals_data = {
@@ -1296,8 +1425,8 @@ def doctor_view_case(anomaly_id):
 @app.route('/doctor/anomaly/<int:anomaly_id>/complete', methods=['POST'])
 @doctor_required
 def complete_anomaly(anomaly_id):
-    user = User.query.get(session['user_id'])
-    anomaly = Anomaly.query.get_or_404(anomaly_id)
+    user = current_user()
+    anomaly = db.get_or_404(Anomaly, anomaly_id)
     
     # Verify doctor is assigned to this anomaly
     if anomaly.assigned_doctor_id != user.id:
@@ -1312,14 +1441,16 @@ def complete_anomaly(anomaly_id):
     user.persons_treated += 1
     
     db.session.commit()
+    invalidate_doctor_directory()
+    invalidate_dashboard(anomaly.patient_id)
     
     return jsonify({'status': 'success', 'message': 'Case marked as completed', 'persons_treated': user.persons_treated})
 
 @app.route('/doctor/anomaly/<int:anomaly_id>/transfer')
 @doctor_required
 def transfer_anomaly_page(anomaly_id):
-    user = User.query.get(session['user_id'])
-    anomaly = Anomaly.query.get_or_404(anomaly_id)
+    user = current_user()
+    anomaly = db.get_or_404(Anomaly, anomaly_id)
     
     # Verify doctor is assigned to this anomaly
     if anomaly.assigned_doctor_id != user.id:
@@ -1327,10 +1458,7 @@ def transfer_anomaly_page(anomaly_id):
         return redirect(url_for('doctor_cases'))
     
     # Get all other doctors (excluding current doctor)
-    other_doctors = User.query.filter(
-        User.user_type == 'doctor',
-        User.id != user.id
-    ).all()
+    other_doctors = [doctor for doctor in get_doctor_directory() if doctor.id != user.id]
     
     return render_template('doctor/transfer_case.html',
                          user=user,
@@ -1341,9 +1469,9 @@ def transfer_anomaly_page(anomaly_id):
 @app.route('/doctor/anomaly/<int:anomaly_id>/transfer/<int:new_doctor_id>', methods=['POST'])
 @doctor_required
 def transfer_anomaly(anomaly_id, new_doctor_id):
-    user = User.query.get(session['user_id'])
-    anomaly = Anomaly.query.get_or_404(anomaly_id)
-    new_doctor = User.query.get_or_404(new_doctor_id)
+    user = current_user()
+    anomaly = db.get_or_404(Anomaly, anomaly_id)
+    new_doctor = db.get_or_404(User, new_doctor_id)
     
     # Verify doctor is assigned to this anomaly
     if anomaly.assigned_doctor_id != user.id:
@@ -1361,455 +1489,546 @@ def transfer_anomaly(anomaly_id, new_doctor_id):
     
     return jsonify({'status': 'success', 'message': f'Case transferred to Dr. {new_doctor.first_name} {new_doctor.last_name}'})
 
-@app.route('/doctor/case/<int:anomaly_id>/generate-pdf')
-@doctor_required
-def generate_case_pdf(anomaly_id):
-    user = User.query.get(session['user_id'])
-    anomaly = Anomaly.query.get_or_404(anomaly_id)
+@lru_cache(maxsize=1)
+def load_matplotlib():
+    """Import matplotlib with the non-interactive backend on first use"""
+    import matplotlib
+    matplotlib.use('Agg')  # Use non-interactive backend
+    # Figures are built with the OO API: pyplot's global figure state isn't thread-safe
+    from matplotlib.figure import Figure
+    from mpl_toolkits.mplot3d import Axes3D  # registers the '3d' projection
+    return Figure
+
+def render_trend_chart(fig, title, ylabel, dates, series, ylabel_color=None, fill_alpha=0.3):
+    """Draw one vitals trend on a reused figure and return it as a PNG buffer"""
+    fig.clear()
+    ax = fig.add_subplot()
+    for values, color, marker, label in series:
+        ax.plot(dates, values, color=color, linewidth=2, marker=marker, markersize=3, label=label)
+        ax.fill_between(dates, values, alpha=fill_alpha, color=color)
+    ax.set_xlabel('Date/Time', fontsize=9)
+    if ylabel_color:
+        ax.set_ylabel(ylabel, fontsize=9, color=ylabel_color)
+    else:
+        ax.set_ylabel(ylabel, fontsize=9)
+    ax.set_title(title, fontsize=11, fontweight='bold')
+    if len(series) > 1:
+        ax.legend(loc='best', fontsize=8)
+    ax.grid(True, alpha=0.3)
+    ax.tick_params(axis='x', rotation=45, labelsize=7)
+    fig.tight_layout()
+    # No bbox_inches='tight' - tight_layout already fits the labels, and it would render twice
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=100)
+    buffer.seek(0)
+    return buffer
+
+def load_case_report(anomaly_id, doctor):
+    """Load what a case report is built from and its version, or None unless doctor is assigned to the case"""
+    # Load the case together with its patient
+    anomaly = Anomaly.query.options(joinedload(Anomaly.patient)).filter(Anomaly.id == anomaly_id).first_or_404()
     
     # Verify doctor is assigned to this anomaly
-    if anomaly.assigned_doctor_id != user.id:
-        flash('Unauthorized access.', 'error')
-        return redirect(url_for('doctor_cases'))
-    
-    patient = User.query.get(anomaly.patient_id)
+    if anomaly.assigned_doctor_id != doctor.id:
+        return None
     
-    # Get last 30 vitals related to this case
-    related_vitals = Vital.query.filter(
-        Vital.patient_id == anomaly.patient_id,
-        Vital.recorded_at <= anomaly.detected_at
-    ).order_by(Vital.recorded_at.desc()).limit(30).all()
-    related_vitals = list(reversed(related_vitals))
+    patient = anomaly.patient
     
-    # Get latest vital
-    latest_vital = Vital.query.filter_by(patient_id=anomaly.patient_id).order_by(Vital.recorded_at.desc()).first()
+    # Get last 30 vitals related to this case (oldest first) and the latest vital, in one query
+    related_vitals, latest_vital = get_case_vitals(anomaly.patient_id, anomaly.detected_at)
     
     # Get all anomalies for this patient to determine disease risks
     all_patient_anomalies = Anomaly.query.filter_by(patient_id=anomaly.patient_id).all()
     
-    # Disease features mapping
-    disease_features = {
-        "Neurological": ["sleep_entropy", "sleep_transition_rate", "hr_irregularity"],
-        "Cardiovascular": ["hr_mean", "sbp_trend", "bp_gap"],
-        "Respiratory": ["spo2_trend", "spo2_variability", "hr_mean", "bp_gap"],
-        "Infectious": ["hr_mean", "hrv"],
-        "Metabolic": ["bp_gap", "hr_mean"],
-        "Mental Health": ["sleep_entropy", "sleep_transition_rate"]
-    }
-    
-    feature_explain = {
-        "sleep_entropy": "high sleep fragmentation",
-        "sleep_transition_rate": "frequent sleep stage changes",
-        "hrv": "abnormal heart rate variability",
-        "hr_irregularity": "irregular heart rate pattern",
-        "hr_mean": "abnormal heart rate",
-        "sbp_trend": "unstable systolic blood pressure",
-        "bp_gap": "abnormal pulse pressure",
-        "spo2_trend": "falling oxygen saturation",
-        "spo2_variability": "high oxygen saturation swings"
-    }
-    
-    # Generate 3D map based on actual anomaly data
-    diseases = list(disease_features.keys())
-    features = list(feature_explain.keys())
-    disease_idx = {d: i for i, d in enumerate(diseases)}
-    feature_idx = {f: i for i, f in enumerate(features)}
-    
-    # Map anomaly types to diseases and calculate scores
-    x, y, z = [], [], []
-    anomaly_disease_map = {}
-    
-    for patient_anomaly in all_patient_anomalies:
-        anomaly_type = patient_anomaly.anomaly_type.lower()
-        risk_score = patient_anomaly.risk_score if patient_anomaly.risk_score else 0.5
-        
-        # Map anomaly type to disease category
-        for disease, feats in disease_features.items():
-            if disease.lower().replace(' ', '_') in anomaly_type or anomaly_type in disease.lower():
-                anomaly_disease_map[disease] = max(anomaly_disease_map.get(disease, 0), risk_score)
-                for feat in feats:
-                    if feat in feature_idx:
-                        x.append(disease_idx[disease])
-                        y.append(feature_idx[feat])
-                        z.append(risk_score)
-    
-    # If no anomalies mapped, use the current anomaly
-    if not x:
-        anomaly_type = anomaly.anomaly_type.lower()
-        risk_score = anomaly.risk_score if anomaly.risk_score else 0.7
-        
-        for disease, feats in disease_features.items():
-            if disease.lower().replace(' ', '_') in anomaly_type or anomaly_type in disease.lower():
-                for feat in feats:
-                    if feat in feature_idx:
-                        x.append(disease_idx[disease])
-                        y.append(feature_idx[feat])
-                        z.append(risk_score)
-    
-    # Generate 3D map image
-    img_buffer = io.BytesIO()
-    if x and y and z:
-        fig = plt.figure(figsize=(10, 7))
-        ax = fig.add_subplot(111, projection="3d")
-        
-        scatter = ax.scatter(x, y, z, c=z, cmap="viridis", s=120)
-        
-        ax.set_xlabel("Disease Category")
-        ax.set_ylabel("Physiological Feature")
-        ax.set_zlabel("Anomaly Severity")
-        
-        ax.set_xticks(range(len(diseases)))
-        ax.set_xticklabels(diseases, rotation=30, ha="right")
-        
-        ax.set_yticks(range(len(features)))
-        ax.set_yticklabels(features, fontsize=8)
-        
-        plt.colorbar(scatter, pad=0.1, label="Severity Score")
-        plt.title("3D Disease–Feature Anomaly Map")
-        
-        plt.tight_layout()
-        plt.savefig(img_buffer, format='png', dpi=200, bbox_inches='tight')
-        plt.close()
-        img_buffer.seek(0)
-    
-    # Generate summaries
-    doctor_summary = "<b>Clinical Interpretation</b><br/>"
-    patient_summary = "<b>Patient-Friendly Summary</b><br/>"
-    
-    # Build doctor summary from detected anomalies
-    detected_diseases = set()
-    for patient_anomaly in all_patient_anomalies:
-        anomaly_type = patient_anomaly.anomaly_type.lower()
-        for disease in disease_features.keys():
-            if disease.lower().replace(' ', '_') in anomaly_type or anomaly_type in disease.lower():
-                detected_diseases.add(disease)
-    
-    for disease in detected_diseases:
-        if disease in disease_features:
-            doctor_summary += f"<br/><b>{disease}</b><br/>"
-            for feat in disease_features[disease]:
-                if feat in feature_explain:
-                    doctor_summary += f"- {feature_explain[feat]}<br/>"
-    
-    if not detected_diseases:
-        # Fallback to current anomaly
-        doctor_summary += f"<br/><b>{anomaly.anomaly_type.replace('_', ' ').title()}</b><br/>"
-        doctor_summary += f"- {anomaly.description or 'Anomaly detected'}<br/>"
-    
-    patient_summary += (
-        "Multiple physiological signals show abnormal patterns. "
-        "These patterns may indicate stress on neurological, "
-        "cardiovascular, respiratory, or metabolic systems. "
-        "Please consult a healthcare professional for confirmation."
+    # The report only changes with the case, the patient's profile, their anomalies or a
+    # newer vital - reuse the last rendering (charts and all) until one of those does
+    report_version = (
+        anomaly.case_status, anomaly.assigned_at, doctor.first_name, doctor.last_name,
+        patient.first_name, patient.last_name, patient.email, patient.phone, patient.date_of_birth,
+        latest_vital.id if latest_vital else None,
+        tuple((a.id, a.anomaly_type, a.risk_score) for a in all_patient_anomalies),
     )
-    
-    # Create PDF in memory
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=72, leftMargin=72, topMargin=72, bottomMargin=18)
-    
-    # Container for the 'Flowable' objects
-    elements = []
-    
-    # Define styles
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=24,
-        textColor=colors.HexColor('#1e293b'),
-        spaceAfter=30,
-        alignment=TA_CENTER
-    )
-    
-    heading_style = ParagraphStyle(
-        'CustomHeading',
-        parent=styles['Heading2'],
-        fontSize=16,
-        textColor=colors.HexColor('#334155'),
-        spaceAfter=12,
-        spaceBefore=20
-    )
-    
-    # Title
-    elements.append(Paragraph("Health Anomaly Assessment Report", title_style))
-    elements.append(Spacer(1, 0.2*inch))
-    
-    # Case Information
-    elements.append(Paragraph("Case Information", heading_style))
-    case_data = [
-        ['Anomaly Type:', anomaly.anomaly_type.replace('_', ' ').title()],
-        ['Severity:', anomaly.severity.upper()],
-        ['Status:', anomaly.case_status.upper()],
-        ['Risk Score:', f"{anomaly.risk_score:.3f}" if anomaly.risk_score else 'N/A'],
-        ['Detected At:', anomaly.detected_at.strftime('%B %d, %Y at %H:%M UTC')],
-    ]
-    if anomaly.assigned_at:
-        case_data.append(['Assigned At:', anomaly.assigned_at.strftime('%B %d, %Y at %H:%M UTC')])
-    
-    case_table = Table(case_data, colWidths=[2*inch, 4*inch])
-    case_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f1f5f9')),
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.HexColor('#1e293b')),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#e2e8f0'))
-    ]))
-    elements.append(case_table)
-    elements.append(Spacer(1, 0.3*inch))
-    
-    # Patient Information
-    elements.append(Paragraph("Patient Information", heading_style))
-    patient_data = [
-        ['Name:', f"{patient.first_name} {patient.last_name}"],
-        ['Email:', patient.email],
-        ['Phone:', patient.phone or 'N/A'],
-    ]
-    if patient.date_of_birth:
-        patient_data.append(['Date of Birth:', patient.date_of_birth.strftime('%B %d, %Y')])
-    
-    patient_table = Table(patient_data, colWidths=[2*inch, 4*inch])
-    patient_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f1f5f9')),
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.HexColor('#1e293b')),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#e2e8f0'))
-    ]))
-    elements.append(patient_table)
-    elements.append(Spacer(1, 0.3*inch))
-    
-    # Description
-    if anomaly.description:
-        elements.append(Paragraph("Description", heading_style))
-        elements.append(Paragraph(anomaly.description, styles['Normal']))
+    return anomaly, related_vitals, latest_vital, all_patient_anomalies, report_version
+
+def case_report_filename(anomaly):
+    """Download name for a case report PDF"""
+    patient = anomaly.patient
+    return f"Health_Anomaly_Report_{anomaly.id}_{patient.first_name}_{patient.last_name}_{anomaly.detected_at.strftime('%Y%m%d')}.pdf"
+
+def build_case_pdf(anomaly_id, doctor_id):
+    """Render a case report PDF (runs on _report_jobs), cache it and return its bytes"""
+    # Charting/PDF libraries are only needed here - keep them off the startup path
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import inch
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, PageBreak, Image
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER
+    Figure = load_matplotlib()
+
+    with app.app_context():
+        user = db.session.get(User, doctor_id)
+        case_report = load_case_report(anomaly_id, user)
+        if case_report is None:
+            raise PermissionError(f"Doctor {doctor_id} is no longer assigned to anomaly {anomaly_id}")
+        anomaly, related_vitals, latest_vital, all_patient_anomalies, report_version = case_report
+        patient = anomaly.patient
+
+        # Map anomaly types to diseases and calculate scores
+        disease_matches = case_disease_matrix([a.anomaly_type for a in all_patient_anomalies])
+        x, y, z = case_map_points(disease_matches, [a.risk_score or 0.5 for a in all_patient_anomalies])
+
+        # If no anomalies mapped, use the current anomaly
+        if not len(x):
+            x, y, z = case_map_points(case_disease_matrix([anomaly.anomaly_type]), [anomaly.risk_score or 0.7])
+
+        # Generate 3D map image
+        img_buffer = io.BytesIO()
+        if len(x):
+            fig = Figure(figsize=(10, 7))
+            ax = fig.add_subplot(111, projection="3d")
+
+            scatter = ax.scatter(x, y, z, c=z, cmap="viridis", s=120)
+
+            ax.set_xlabel("Disease Category")
+            ax.set_ylabel("Physiological Feature")
+            ax.set_zlabel("Anomaly Severity")
+
+            ax.set_xticks(range(len(CASE_DISEASE_FEATURES)))
+            ax.set_xticklabels(list(CASE_DISEASE_FEATURES), rotation=30, ha="right")
+
+            ax.set_yticks(range(len(CASE_FEATURE_EXPLAIN)))
+            ax.set_yticklabels(list(CASE_FEATURE_EXPLAIN), fontsize=8)
+
+            fig.colorbar(scatter, ax=ax, pad=0.1, label="Severity Score")
+            ax.set_title("3D Disease–Feature Anomaly Map")
+
+            fig.tight_layout()
+            # The scatter's colour gradients compress far better as JPEG, and 100 dpi of a
+            # 10x7in figure is still ~160 dpi at the 450x320pt size it's shown in the PDF
+            fig.savefig(img_buffer, format='jpeg', dpi=100, pil_kwargs={'quality': 85, 'optimize': True})
+            img_buffer.seek(0)
+
+        # Generate summaries
+        doctor_summary = "<b>Clinical Interpretation</b><br/>"
+        patient_summary = "<b>Patient-Friendly Summary</b><br/>"
+
+        # Build doctor summary from detected anomalies
+        detected_diseases = [
+            disease for disease, detected in zip(CASE_DISEASE_FEATURES, disease_matches.any(axis=0)) if detected
+        ]
+
+        for disease in detected_diseases:
+            doctor_summary += f"<br/><b>{disease}</b><br/>"
+            for feat in CASE_DISEASE_FEATURES[disease]:
+                doctor_summary += f"- {CASE_FEATURE_EXPLAIN[feat]}<br/>"
+
+        if not detected_diseases:
+            # Fallback to current anomaly
+            doctor_summary += f"<br/><b>{anomaly.anomaly_type.replace('_', ' ').title()}</b><br/>"
+            doctor_summary += f"- {anomaly.description or 'Anomaly detected'}<br/>"
+
+        patient_summary += (
+            "Multiple physiological signals show abnormal patterns. "
+            "These patterns may indicate stress on neurological, "
+            "cardiovascular, respiratory, or metabolic systems. "
+            "Please consult a healthcare professional for confirmation."
+        )
+
+        # Spills to a temp file past REPORT_SPOOL_SIZE, so big reports never sit in RAM whole
+        buffer = tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_SIZE, mode='w+b')
+        doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=72, leftMargin=72, topMargin=72, bottomMargin=18)
+
+        # Container for the 'Flowable' objects
+        elements = []
+
+        # Define styles
+        styles = getSampleStyleSheet()
+        title_style = ParagraphStyle(
+            'CustomTitle',
+            parent=styles['Heading1'],
+            fontSize=24,
+            textColor=colors.HexColor('#1e293b'),
+            spaceAfter=30,
+            alignment=TA_CENTER
+        )
+
+        heading_style = ParagraphStyle(
+            'CustomHeading',
+            parent=styles['Heading2'],
+            fontSize=16,
+            textColor=colors.HexColor('#334155'),
+            spaceAfter=12,
+            spaceBefore=20
+        )
+
+        # Title
+        elements.append(Paragraph("Health Anomaly Assessment Report", title_style))
+        elements.append(Spacer(1, 0.2*inch))
+
+        # Case Information
+        elements.append(Paragraph("Case Information", heading_style))
+        case_data = [
+            ['Anomaly Type:', anomaly.anomaly_type.replace('_', ' ').title()],
+            ['Severity:', anomaly.severity.upper()],
+            ['Status:', anomaly.case_status.upper()],
+            ['Risk Score:', f"{anomaly.risk_score:.3f}" if anomaly.risk_score else 'N/A'],
+            ['Detected At:', anomaly.detected_at.strftime('%B %d, %Y at %H:%M UTC')],
+        ]
+        if anomaly.assigned_at:
+            case_data.append(['Assigned At:', anomaly.assigned_at.strftime('%B %d, %Y at %H:%M UTC')])
+
+        case_table = Table(case_data, colWidths=[2*inch, 4*inch])
+        case_table.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f1f5f9')),
+            ('TEXTCOLOR', (0, 0), (-1, -1), colors.HexColor('#1e293b')),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+            ('TOPPADDING', (0, 0), (-1, -1), 8),
+            ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#e2e8f0'))
+        ]))
+        elements.append(case_table)
         elements.append(Spacer(1, 0.3*inch))
-    
-    # Clinical Interpretation
-    elements.append(PageBreak())
-    elements.append(Paragraph("Clinical Interpretation", heading_style))
-    elements.append(Paragraph(doctor_summary, styles['Normal']))
-    elements.append(Spacer(1, 0.3*inch))
-    
-    # Patient-Friendly Summary
-    elements.append(Paragraph("Patient-Friendly Summary", heading_style))
-    elements.append(Paragraph(patient_summary, styles['Normal']))
-    elements.append(Spacer(1, 0.3*inch))
-    
-    # Generate 2D vital charts
-    chart_images = []
-    
-    if related_vitals:
-        # Prepare chart data
-        dates = [v.recorded_at.strftime('%Y-%m-%d %H:%M') for v in related_vitals]
-        heart_rates = [v.heart_rate for v in related_vitals if v.heart_rate]
-        spo2_values = [v.oxygen_saturation for v in related_vitals if v.oxygen_saturation]
-        bp_systolic = [v.blood_pressure_systolic for v in related_vitals if v.blood_pressure_systolic]
-        bp_diastolic = [v.blood_pressure_diastolic for v in related_vitals if v.blood_pressure_diastolic]
-        resp_rates = [v.respiratory_rate for v in related_vitals if v.respiratory_rate]
-        
-        # Heart Rate Chart
-        if heart_rates:
-            hr_dates = [dates[i] for i, v in enumerate(related_vitals) if v.heart_rate]
-            fig, ax = plt.subplots(figsize=(8, 4))
-            ax.plot(hr_dates, heart_rates, color='#ef4444', linewidth=2, marker='o', markersize=3)
-            ax.fill_between(hr_dates, heart_rates, alpha=0.3, color='#ef4444')
-            ax.set_xlabel('Date/Time', fontsize=9)
-            ax.set_ylabel('Heart Rate (BPM)', fontsize=9, color='#ef4444')
-            ax.set_title('Heart Rate Trend', fontsize=11, fontweight='bold')
-            ax.grid(True, alpha=0.3)
-            ax.tick_params(axis='x', rotation=45, labelsize=7)
-            plt.tight_layout()
-            hr_buffer = io.BytesIO()
-            plt.savefig(hr_buffer, format='png', dpi=150, bbox_inches='tight')
-            plt.close()
-            hr_buffer.seek(0)
-            chart_images.append(('Heart Rate Trend', hr_buffer))
-        
-        # SpO2 Chart
-        if spo2_values:
-            spo2_dates = [dates[i] for i, v in enumerate(related_vitals) if v.oxygen_saturation]
-            fig, ax = plt.subplots(figsize=(8, 4))
-            ax.plot(spo2_dates, spo2_values, color='#10b981', linewidth=2, marker='o', markersize=3)
-            ax.fill_between(spo2_dates, spo2_values, alpha=0.3, color='#10b981')
-            ax.set_xlabel('Date/Time', fontsize=9)
-            ax.set_ylabel('Oxygen Saturation (SpO2%)', fontsize=9, color='#10b981')
-            ax.set_title('Oxygen Saturation Trend', fontsize=11, fontweight='bold')
-            ax.grid(True, alpha=0.3)
-            ax.tick_params(axis='x', rotation=45, labelsize=7)
-            plt.tight_layout()
-            spo2_buffer = io.BytesIO()
-            plt.savefig(spo2_buffer, format='png', dpi=150, bbox_inches='tight')
-            plt.close()
-            spo2_buffer.seek(0)
-            chart_images.append(('Oxygen Saturation Trend', spo2_buffer))
-        
-        # Blood Pressure Chart
-        if bp_systolic and bp_diastolic:
-            bp_dates = [dates[i] for i, v in enumerate(related_vitals) if v.blood_pressure_systolic and v.blood_pressure_diastolic]
-            bp_sys = [v.blood_pressure_systolic for v in related_vitals if v.blood_pressure_systolic and v.blood_pressure_diastolic]
-            bp_dia = [v.blood_pressure_diastolic for v in related_vitals if v.blood_pressure_systolic and v.blood_pressure_diastolic]
-            fig, ax = plt.subplots(figsize=(8, 4))
-            ax.plot(bp_dates, bp_sys, color='#3b82f6', linewidth=2, marker='o', markersize=3, label='Systolic')
-            ax.plot(bp_dates, bp_dia, color='#8b5cf6', linewidth=2, marker='s', markersize=3, label='Diastolic')
-            ax.fill_between(bp_dates, bp_sys, alpha=0.2, color='#3b82f6')
-            ax.fill_between(bp_dates, bp_dia, alpha=0.2, color='#8b5cf6')
-            ax.set_xlabel('Date/Time', fontsize=9)
-            ax.set_ylabel('Blood Pressure (mmHg)', fontsize=9)
-            ax.set_title('Blood Pressure Trend', fontsize=11, fontweight='bold')
-            ax.legend(loc='best', fontsize=8)
-            ax.grid(True, alpha=0.3)
-            ax.tick_params(axis='x', rotation=45, labelsize=7)
-            plt.tight_layout()
-            bp_buffer = io.BytesIO()
-            plt.savefig(bp_buffer, format='png', dpi=150, bbox_inches='tight')
-            plt.close()
-            bp_buffer.seek(0)
-            chart_images.append(('Blood Pressure Trend', bp_buffer))
-        
-        # Respiratory Rate Chart
-        if resp_rates:
-            resp_dates = [dates[i] for i, v in enumerate(related_vitals) if v.respiratory_rate]
-            fig, ax = plt.subplots(figsize=(8, 4))
-            ax.plot(resp_dates, resp_rates, color='#f59e0b', linewidth=2, marker='o', markersize=3)
-            ax.fill_between(resp_dates, resp_rates, alpha=0.3, color='#f59e0b')
-            ax.set_xlabel('Date/Time', fontsize=9)
-            ax.set_ylabel('Respiratory Rate (breaths/min)', fontsize=9, color='#f59e0b')
-            ax.set_title('Respiratory Rate Trend', fontsize=11, fontweight='bold')
-            ax.grid(True, alpha=0.3)
-            ax.tick_params(axis='x', rotation=45, labelsize=7)
-            plt.tight_layout()
-            resp_buffer = io.BytesIO()
-            plt.savefig(resp_buffer, format='png', dpi=150, bbox_inches='tight')
-            plt.close()
-            resp_buffer.seek(0)
-            chart_images.append(('Respiratory Rate Trend', resp_buffer))
-    
-    # 3D Disease-Feature Map
-    if img_buffer and len(x) > 0:
-        elements.append(PageBreak())
-        elements.append(Paragraph("3D Disease–Feature Anomaly Map", heading_style))
-        img_buffer.seek(0)
-        elements.append(Image(img_buffer, width=450, height=320))
+
+        # Patient Information
+        elements.append(Paragraph("Patient Information", heading_style))
+        patient_data = [
+            ['Name:', f"{patient.first_name} {patient.last_name}"],
+            ['Email:', patient.email],
+            ['Phone:', patient.phone or 'N/A'],
+        ]
+        if patient.date_of_birth:
+            patient_data.append(['Date of Birth:', patient.date_of_birth.strftime('%B %d, %Y')])
+
+        patient_table = Table(patient_data, colWidths=[2*inch, 4*inch])
+        patient_table.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f1f5f9')),
+            ('TEXTCOLOR', (0, 0), (-1, -1), colors.HexColor('#1e293b')),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+            ('TOPPADDING', (0, 0), (-1, -1), 8),
+            ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#e2e8f0'))
+        ]))
+        elements.append(patient_table)
         elements.append(Spacer(1, 0.3*inch))
-    
-    # Add 2D Vital Charts
-    if chart_images:
+
+        # Description
+        if anomaly.description:
+            elements.append(Paragraph("Description", heading_style))
+            elements.append(Paragraph(anomaly.description, styles['Normal']))
+            elements.append(Spacer(1, 0.3*inch))
+
+        # Clinical Interpretation
         elements.append(PageBreak())
-        elements.append(Paragraph("Vital Signs Trends", heading_style))
-        elements.append(Spacer(1, 0.2*inch))
-        
-        for chart_title, chart_buffer in chart_images:
-            elements.append(Paragraph(chart_title, ParagraphStyle('ChartTitle', parent=styles['Heading3'], fontSize=12, spaceAfter=6)))
-            chart_buffer.seek(0)
-            elements.append(Image(chart_buffer, width=500, height=250))
+        elements.append(Paragraph("Clinical Interpretation", heading_style))
+        elements.append(Paragraph(doctor_summary, styles['Normal']))
+        elements.append(Spacer(1, 0.3*inch))
+
+        # Patient-Friendly Summary
+        elements.append(Paragraph("Patient-Friendly Summary", heading_style))
+        elements.append(Paragraph(patient_summary, styles['Normal']))
+        elements.append(Spacer(1, 0.3*inch))
+
+        # Generate 2D vital charts
+        chart_images = []
+
+        if related_vitals:
+            # Prepare chart data in one pass: falsy readings (None/0) become NaN
+            # and each chart keeps the rows its mask selects
+            dates = np.array([v.recorded_at.strftime('%Y-%m-%d %H:%M') for v in related_vitals])
+            series = np.array([
+                (v.heart_rate, v.oxygen_saturation, v.blood_pressure_systolic,
+                 v.blood_pressure_diastolic, v.respiratory_rate, v.body_temperature)
+                for v in related_vitals
+            ], dtype=float)
+            series[np.isnan(series) | (series == 0)] = np.nan
+            heart_rates, spo2_values, bp_systolic, bp_diastolic, resp_rates, _ = series.T
+            hr_mask, spo2_mask, sys_mask, dia_mask, resp_mask, _ = ~np.isnan(series.T)
+            bp_mask = sys_mask & dia_mask
+
+            # One figure is reused for every trend chart
+            fig = Figure(figsize=(8, 4))
+
+            # Heart Rate Chart
+            if hr_mask.any():
+                chart_images.append(('Heart Rate Trend', render_trend_chart(
+                    fig, 'Heart Rate Trend', 'Heart Rate (BPM)', dates[hr_mask],
+                    [(heart_rates[hr_mask], '#ef4444', 'o', None)], ylabel_color='#ef4444')))
+
+            # SpO2 Chart
+            if spo2_mask.any():
+                chart_images.append(('Oxygen Saturation Trend', render_trend_chart(
+                    fig, 'Oxygen Saturation Trend', 'Oxygen Saturation (SpO2%)', dates[spo2_mask],
+                    [(spo2_values[spo2_mask], '#10b981', 'o', None)], ylabel_color='#10b981')))
+
+            # Blood Pressure Chart
+            if sys_mask.any() and dia_mask.any():
+                chart_images.append(('Blood Pressure Trend', render_trend_chart(
+                    fig, 'Blood Pressure Trend', 'Blood Pressure (mmHg)', dates[bp_mask],
+                    [(bp_systolic[bp_mask], '#3b82f6', 'o', 'Systolic'),
+                     (bp_diastolic[bp_mask], '#8b5cf6', 's', 'Diastolic')],
+                    fill_alpha=0.2)))
+
+            # Respiratory Rate Chart
+            if resp_mask.any():
+                chart_images.append(('Respiratory Rate Trend', render_trend_chart(
+                    fig, 'Respiratory Rate Trend', 'Respiratory Rate (breaths/min)', dates[resp_mask],
+                    [(resp_rates[resp_mask], '#f59e0b', 'o', None)], ylabel_color='#f59e0b')))
+
+        # 3D Disease-Feature Map
+        if len(x) > 0:
+            elements.append(PageBreak())
+            elements.append(Paragraph("3D Disease–Feature Anomaly Map", heading_style))
+            img_buffer.seek(0)
+            elements.append(Image(img_buffer, width=450, height=320))
+            elements.append(Spacer(1, 0.3*inch))
+
+        # Add 2D Vital Charts
+        if chart_images:
+            elements.append(PageBreak())
+            elements.append(Paragraph("Vital Signs Trends", heading_style))
             elements.append(Spacer(1, 0.2*inch))
-    
-    # Current Vital Metrics
-    if latest_vital:
-        elements.append(Paragraph("Current Vital Metrics", heading_style))
-        vitals_data = []
-        if latest_vital.heart_rate:
-            vitals_data.append(['Heart Rate:', f"{latest_vital.heart_rate:.0f} BPM"])
-        if latest_vital.oxygen_saturation:
-            vitals_data.append(['Oxygen Saturation (SpO2):', f"{latest_vital.oxygen_saturation:.0f}%"])
-        if latest_vital.blood_pressure_systolic and latest_vital.blood_pressure_diastolic:
-            vitals_data.append(['Blood Pressure:', f"{latest_vital.blood_pressure_systolic:.0f}/{latest_vital.blood_pressure_diastolic:.0f} mmHg"])
-        if latest_vital.respiratory_rate:
-            vitals_data.append(['Respiratory Rate:', f"{latest_vital.respiratory_rate:.0f} breaths/min"])
-        if latest_vital.body_temperature:
-            vitals_data.append(['Body Temperature:', f"{latest_vital.body_temperature:.1f} °C"])
-        if latest_vital.steps:
-            vitals_data.append(['Steps:', f"{latest_vital.steps} steps"])
-        
-        if vitals_data:
-            vitals_table = Table(vitals_data, colWidths=[2.5*inch, 3.5*inch])
-            vitals_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f1f5f9')),
-                ('TEXTCOLOR', (0, 0), (-1, -1), colors.HexColor('#1e293b')),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, -1), 10),
-                ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-                ('TOPPADDING', (0, 0), (-1, -1), 8),
-                ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#e2e8f0'))
+
+            for chart_title, chart_buffer in chart_images:
+                elements.append(Paragraph(chart_title, ParagraphStyle('ChartTitle', parent=styles['Heading3'], fontSize=12, spaceAfter=6)))
+                chart_buffer.seek(0)
+                elements.append(Image(chart_buffer, width=500, height=250))
+                elements.append(Spacer(1, 0.2*inch))
+
+        # Current Vital Metrics
+        if latest_vital:
+            elements.append(Paragraph("Current Vital Metrics", heading_style))
+            vitals_data = []
+            if latest_vital.heart_rate:
+                vitals_data.append(['Heart Rate:', f"{latest_vital.heart_rate:.0f} BPM"])
+            if latest_vital.oxygen_saturation:
+                vitals_data.append(['Oxygen Saturation (SpO2):', f"{latest_vital.oxygen_saturation:.0f}%"])
+            if latest_vital.blood_pressure_systolic and latest_vital.blood_pressure_diastolic:
+                vitals_data.append(['Blood Pressure:', f"{latest_vital.blood_pressure_systolic:.0f}/{latest_vital.blood_pressure_diastolic:.0f} mmHg"])
+            if latest_vital.respiratory_rate:
+                vitals_data.append(['Respiratory Rate:', f"{latest_vital.respiratory_rate:.0f} breaths/min"])
+            if latest_vital.body_temperature:
+                vitals_data.append(['Body Temperature:', f"{latest_vital.body_temperature:.1f} °C"])
+            if latest_vital.steps:
+                vitals_data.append(['Steps:', f"{latest_vital.steps} steps"])
+
+            if vitals_data:
+                vitals_table = Table(vitals_data, colWidths=[2.5*inch, 3.5*inch])
+                vitals_table.setStyle(TableStyle([
+                    ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f1f5f9')),
+                    ('TEXTCOLOR', (0, 0), (-1, -1), colors.HexColor('#1e293b')),
+                    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+                    ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+                    ('FONTSIZE', (0, 0), (-1, -1), 10),
+                    ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+                    ('TOPPADDING', (0, 0), (-1, -1), 8),
+                    ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#e2e8f0'))
+                ]))
+                elements.append(vitals_table)
+                elements.append(Spacer(1, 0.3*inch))
+
+        # Vitals Timeline Data
+        if related_vitals:
+            elements.append(PageBreak())
+            elements.append(Paragraph("Vitals Timeline (Last 30 Records)", heading_style))
+
+            # Prepare table data a column at a time from the chart series above;
+            # NaN marks a missing (None/0) reading, shown as N/A
+            missing = np.isnan(series)
+            hr_col, spo2_col, sys_col, dia_col, resp_col, temp_col = (
+                np.where(missing[:, i], 'N/A', np.char.mod(fmt, series[:, i]))
+                for i, fmt in enumerate(('%.0f', '%.0f', '%.0f', '%.0f', '%.0f', '%.1f'))
+            )
+            bp_col = np.where(missing[:, 2] | missing[:, 3], 'N/A', np.char.add(np.char.add(sys_col, '/'), dia_col))
+            table_data = [['Date/Time', 'HR (BPM)', 'SpO2 (%)', 'BP (mmHg)', 'RR', 'Temp (°C)']]
+            table_data.extend(map(list, zip(
+                dates.tolist(), hr_col.tolist(), spo2_col.tolist(), bp_col.tolist(), resp_col.tolist(), temp_col.tolist()
+            )))
+
+            # Create table
+            vitals_timeline_table = Table(table_data, colWidths=[1.2*inch, 0.8*inch, 0.8*inch, 1*inch, 0.7*inch, 0.8*inch])
+            vitals_timeline_table.setStyle(TableStyle([
+                ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#334155')),
+                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                ('FONTSIZE', (0, 0), (-1, 0), 9),
+                ('FONTSIZE', (0, 1), (-1, -1), 8),
+                ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+                ('TOPPADDING', (0, 0), (-1, -1), 6),
+                ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#e2e8f0')),
+                ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f8fafc')])
             ]))
-            elements.append(vitals_table)
-            elements.append(Spacer(1, 0.3*inch))
-    
-    # Vitals Timeline Data
-    if related_vitals:
-        elements.append(PageBreak())
-        elements.append(Paragraph("Vitals Timeline (Last 30 Records)", heading_style))
-        
-        # Prepare table data
-        table_data = [['Date/Time', 'HR (BPM)', 'SpO2 (%)', 'BP (mmHg)', 'RR', 'Temp (°C)']]
-        
-        for vital in related_vitals:
-            row = [
-                vital.recorded_at.strftime('%Y-%m-%d %H:%M'),
-                f"{vital.heart_rate:.0f}" if vital.heart_rate else 'N/A',
-                f"{vital.oxygen_saturation:.0f}" if vital.oxygen_saturation else 'N/A',
-                f"{vital.blood_pressure_systolic:.0f}/{vital.blood_pressure_diastolic:.0f}" if vital.blood_pressure_systolic and vital.blood_pressure_diastolic else 'N/A',
-                f"{vital.respiratory_rate:.0f}" if vital.respiratory_rate else 'N/A',
-                f"{vital.body_temperature:.1f}" if vital.body_temperature else 'N/A'
-            ]
-            table_data.append(row)
-        
-        # Create table
-        vitals_timeline_table = Table(table_data, colWidths=[1.2*inch, 0.8*inch, 0.8*inch, 1*inch, 0.7*inch, 0.8*inch])
-        vitals_timeline_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#334155')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 9),
-            ('FONTSIZE', (0, 1), (-1, -1), 8),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-            ('TOPPADDING', (0, 0), (-1, -1), 6),
-            ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#e2e8f0')),
-            ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f8fafc')])
-        ]))
-        elements.append(vitals_timeline_table)
-    
-    # Footer
-    elements.append(Spacer(1, 0.5*inch))
-    elements.append(Paragraph(f"Generated on {datetime.utcnow().strftime('%B %d, %Y at %H:%M UTC')}", 
-                              ParagraphStyle('Footer', parent=styles['Normal'], fontSize=8, 
-                                           textColor=colors.HexColor('#64748b'), alignment=TA_CENTER)))
-    elements.append(Paragraph(f"Assigned Doctor: Dr. {user.first_name} {user.last_name}", 
-                              ParagraphStyle('Footer', parent=styles['Normal'], fontSize=8, 
-                                           textColor=colors.HexColor('#64748b'), alignment=TA_CENTER)))
-    
-    # Build PDF
-    doc.build(elements)
-    
-    # Get PDF from buffer
-    buffer.seek(0)
-    
-    # Generate filename
-    filename = f"Health_Anomaly_Report_{anomaly.id}_{patient.first_name}_{patient.last_name}_{anomaly.detected_at.strftime('%Y%m%d')}.pdf"
-    
-    return send_file(buffer, mimetype='application/pdf', as_attachment=True, download_name=filename)
+            elements.append(vitals_timeline_table)
+
+        # Footer
+        elements.append(Spacer(1, 0.5*inch))
+        elements.append(Paragraph(f"Generated on {datetime.utcnow().strftime('%B %d, %Y at %H:%M UTC')}", 
+                                  ParagraphStyle('Footer', parent=styles['Normal'], fontSize=8, 
+                                               textColor=colors.HexColor('#64748b'), alignment=TA_CENTER)))
+        elements.append(Paragraph(f"Assigned Doctor: Dr. {user.first_name} {user.last_name}", 
+                                  ParagraphStyle('Footer', parent=styles['Normal'], fontSize=8, 
+                                               textColor=colors.HexColor('#64748b'), alignment=TA_CENTER)))
+
+        # Build PDF
+        doc.build(elements)
+
+    with buffer:
+        size = buffer.tell()
+        buffer.seek(0)
+        pdf = save_case_report(anomaly_id, report_version, buffer)
+        if size <= REPORT_SPOOL_SIZE:
+            # Small enough to also serve this worker's downloads straight from memory
+            buffer.seek(0)
+            pdf = buffer.read()
+
+    with _cache_lock:
+        _pdf_cache[anomaly_id] = (report_version, pdf)
+    logger.info("[REPORT] anomaly=%s bytes=%d in_memory=%s", anomaly_id, size, isinstance(pdf, bytes))
+    return pdf
+
+def case_report_path(anomaly_id, report_version):
+    """Where the report for this version of a case lives in REPORT_DIR"""
+    version_hash = hashlib.sha1(repr(report_version).encode()).hexdigest()[:16]
+    return os.path.join(app.config['REPORT_DIR'], f'case_{anomaly_id}_{version_hash}.pdf')
+
+def save_case_report(anomaly_id, report_version, buffer):
+    """Copy a finished report into REPORT_DIR, drop its older versions and return its path"""
+    report_dir = app.config['REPORT_DIR']
+    os.makedirs(report_dir, exist_ok=True)
+    path = case_report_path(anomaly_id, report_version)
+    # Write then rename so a download never reads a half-written file
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        shutil.copyfileobj(buffer, f)
+    os.replace(tmp_path, path)
+    for stale_path in glob.glob(os.path.join(report_dir, f'case_{anomaly_id}_*.pdf')):
+        if stale_path != path:
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+    return path
+
+def find_case_pdf(anomaly_id, report_version):
+    """This version's report if it's already built - from this worker's cache, else from REPORT_DIR
+    (where another worker may have built it) - or None"""
+    with _cache_lock:
+        cached = _pdf_cache.get(anomaly_id)
+    if cached is not None and cached[0] == report_version:
+        return cached[1]
+    path = case_report_path(anomaly_id, report_version)
+    return path if os.path.exists(path) else None
+
+def open_case_pdf(pdf):
+    """A readable file for a cached report (bytes or the path of its file), or None if its file is gone"""
+    if isinstance(pdf, bytes):
+        return io.BytesIO(pdf)
+    try:
+        return open(pdf, 'rb')
+    except FileNotFoundError:
+        return None
+
+def _forget_report_job(anomaly_id, future):
+    """Drop a finished build from _report_futures; failed ones stay until case_pdf_job reports them"""
+    if future.exception() is not None:
+        return
+    with _cache_lock:
+        running = _report_futures.get(anomaly_id)
+        if running is not None and running[1] is future:
+            del _report_futures[anomaly_id]
+
+def submit_case_pdf(anomaly_id, doctor_id, report_version):
+    """Start a background build of a case report, or join the one already running for this version"""
+    with _cache_lock:
+        running = _report_futures.get(anomaly_id)
+        # A failed build is kept for case_pdf_job to report, but never handed out again
+        if running is not None and running[0] == report_version and not (
+                running[1].done() and running[1].exception() is not None):
+            return running[1]
+        future = _report_jobs.submit(build_case_pdf, anomaly_id, doctor_id)
+        _report_futures[anomaly_id] = (report_version, future)
+    future.add_done_callback(lambda f: _forget_report_job(anomaly_id, f))
+    return future
+
+@app.route('/doctor/case/<int:anomaly_id>/pdf-job', methods=['POST'])
+@doctor_required
+def case_pdf_job(anomaly_id):
+    """Start building a case report in the background and report its status; poll until 'ready', then download"""
+    user = current_user()
+    case_report = load_case_report(anomaly_id, user)
+    if case_report is None:
+        return jsonify({'status': 'error', 'message': 'Unauthorized access.'}), 403
+    report_version = case_report[-1]
+    
+    if find_case_pdf(anomaly_id, report_version) is not None:
+        return jsonify({'status': 'ready', 'download_url': url_for('generate_case_pdf', anomaly_id=anomaly_id)})
+    with _cache_lock:
+        running = _report_futures.get(anomaly_id)
+    if running is not None and running[0] == report_version and running[1].done():
+        # Only failed builds are left behind - report it once, the next request retries
+        with _cache_lock:
+            _report_futures.pop(anomaly_id, None)
+        return jsonify({'status': 'failed', 'message': 'Could not generate the PDF report. Please try again.'})
+    
+    submit_case_pdf(anomaly_id, user.id, report_version)
+    return jsonify({'status': 'pending'}), 202
+
+@app.route('/doctor/case/<int:anomaly_id>/generate-pdf')
+@doctor_required
+def generate_case_pdf(anomaly_id):
+    user = current_user()
+    case_report = load_case_report(anomaly_id, user)
+    if case_report is None:
+        flash('Unauthorized access.', 'error')
+        return redirect(url_for('doctor_cases'))
+    anomaly, report_version = case_report[0], case_report[-1]
+    filename = case_report_filename(anomaly)
+    
+    pdf = find_case_pdf(anomaly_id, report_version)
+    pdf_file = open_case_pdf(pdf) if pdf is not None else None
+    if pdf_file is None:
+        # Not built yet (e.g. a direct link rather than the case page's Generate button), or its
+        # file is gone - build it on the report pool and wait, joining any build already running
+        # for this version on this worker
+        try:
+            pdf = submit_case_pdf(anomaly_id, user.id, report_version).result(timeout=app.config['REPORT_TIMEOUT'])
+            pdf_file = open_case_pdf(pdf)
+            if pdf_file is None:
+                raise FileNotFoundError(pdf)
+        except Exception:
+            logger.exception("[REPORT] Error building case report for anomaly %s", anomaly_id)
+            flash('Could not generate the PDF report. Please try again.', 'error')
+            return redirect(url_for('doctor_view_case', anomaly_id=anomaly_id))
+    
+    # Streamed in blocks (or via the server's file_wrapper) and closed once sent
+    response = send_file(pdf_file, mimetype='application/pdf', as_attachment=True, download_name=filename)
+    if response.content_length is None:
+        # werkzeug only sizes BytesIO buffers itself, not open files
+        response.content_length = os.fstat(pdf_file.fileno()).st_size
+    return response
 
 @app.route('/doctor/accept_request/<int:request_id>', methods=['POST'])
 @doctor_required
 def accept_request(request_id):
-    user = User.query.get(session['user_id'])
+    user = current_user()
     
-    relationship = PatientDoctor.query.get(request_id)
+    # One guarded UPDATE - nothing here needs the row (or its patient/doctor) loaded
+    result = db.session.execute(
+        update(PatientDoctor)
+        .where(PatientDoctor.id == request_id, PatientDoctor.doctor_id == user.id)
+        .values(status='accepted', accepted_at=datetime.utcnow())
+    )
     
-    if not relationship or relationship.doctor_id != user.id:
+    if result.rowcount == 0:
+        db.session.rollback()
         flash('Invalid request.', 'error')
         return redirect(url_for('doctor_dashboard'))
     
-    relationship.status = 'accepted'
-    relationship.accepted_at = datetime.utcnow()
     db.session.commit()
     
     flash('Patient request accepted.', 'success')
@@ -1818,15 +2037,19 @@ def accept_request(request_id):
 @app.route('/doctor/reject_request/<int:request_id>', methods=['POST'])
 @doctor_required
 def reject_request(request_id):
-    user = User.query.get(session['user_id'])
+    user = current_user()
     
-    relationship = PatientDoctor.query.get(request_id)
+    result = db.session.execute(
+        update(PatientDoctor)
+        .where(PatientDoctor.id == request_id, PatientDoctor.doctor_id == user.id)
+        .values(status='rejected')
+    )
     
-    if not relationship or relationship.doctor_id != user.id:
+    if result.rowcount == 0:
+        db.session.rollback()
         flash('Invalid request.', 'error')
         return redirect(url_for('doctor_dashboard'))
     
-    relationship.status = 'rejected'
     db.session.commit()
     
     flash('Patient request rejected.', 'info')
@@ -1865,7 +2088,6 @@ def add_vital():
 def test_upload_route():
     """Test if upload route is accessible"""
     logger.info("Test upload route called")
-    print("[TEST] Upload route test endpoint called", flush=True)
     return jsonify({
         'status': 'success',
         'message': 'Upload route is accessible',
@@ -1876,9 +2098,7 @@ def test_upload_route():
 @app.route('/test-model', methods=['GET'])
 def test_model():
     """Test endpoint to verify model is working"""
-    import sys
-    sys.stdout.flush()
-    print("[TEST] Test endpoint called", flush=True)
+    logger.info("[TEST] Test endpoint called")
     
     try:
         from healio_model import predict_from_csv, healio_predict
@@ -1891,9 +2111,9 @@ def test_model():
             size=(60, 5)
         )
         
-        print(f"[TEST] Calling healio_predict with test data...", flush=True)
+        logger.info("[TEST] Calling healio_predict with test data...")
         result = healio_predict(test_data)
-        print(f"[TEST] Result: {result}", flush=True)
+        logger.info("[TEST] Result: %s", result)
         
         return jsonify({
             'status': 'success',
@@ -1903,7 +2123,7 @@ def test_model():
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
-        print(f"[TEST ERROR] {error_trace}", flush=True)
+        logger.error("[TEST ERROR] %s", error_trace)
         return jsonify({
             'status': 'error',
             'message': str(e),
@@ -1911,9 +2131,5 @@ def test_model():
         }), 500
 
 if __name__ == '__main__':
-    import logging
-    logging.basicConfig(level=logging.DEBUG)
-    print("=" * 80)
-    print("Starting Flask app with debug logging enabled")
-    print("=" * 80)
-    app.run(debug=True, port=5000, use_reloader=False)
+    logger.info("Starting Flask app with debug logging enabled")
+    app.run(debug=True, port=5000, use_reloader=False, threaded=True)
@@ -0,0 +1,28 @@
+"""
+Gunicorn settings for Heal.io
+
+    gunicorn wsgi:app
+
+preload_app imports app.py - and with it healio_model, which builds and
+calibrates the models at import - once in the master process. Workers are
+forked from it, so the model weights are shared copy-on-write instead of being
+rebuilt per worker, and every worker inherits the same SECRET_KEY.
+
+Each worker runs a pool of threads (gthread) so a slow case PDF doesn't hold up
+the vitals API. numpy, matplotlib and ReportLab do their heavy lifting in C, so
+threads suit this better than greenlets, which would only yield on I/O.
+"""
+import os
+
+bind = os.environ.get('HEALIO_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('HEALIO_WORKERS', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('HEALIO_THREADS', 4))
+preload_app = True
+timeout = 120  # First prediction in a worker can be slow
+
+def post_fork(server, worker):
+    # The master opened SQLite connections while creating tables; don't share them with workers
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
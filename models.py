@@ -2,11 +2,26 @@
 Database Models for Heal.io Application
 """
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from datetime import datetime
 
 db = SQLAlchemy()
 
+# Shared argon2id hasher at OWASP's minimum (19 MiB, 2 passes), ~30ms per login
+# instead of ~150ms at 64 MiB. Hashes made with other parameters - and older
+# werkzeug pbkdf2 ones - still verify and are rehashed on the next login.
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+# Anomaly severities in ascending order; rank is the 1-based position
+SEVERITY_LEVELS = ('low', 'medium', 'high', 'critical')
+SEVERITY_RANKS = {level: rank for rank, level in enumerate(SEVERITY_LEVELS, start=1)}
+
+def default_severity_rank(context):
+    """Derive an anomaly's severity_rank from its severity on insert"""
+    return SEVERITY_RANKS.get(context.get_current_parameters().get('severity'), 1)
+
 class User(db.Model):
     """User model for patients and doctors"""
     __tablename__ = 'users'
@@ -44,11 +59,22 @@ class User(db.Model):
     
     def set_password(self, password):
         """Hash and set password"""
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
         """Check if provided password matches hash"""
-        return check_password_hash(self.password_hash, password)
+        if not self.password_hash.startswith('$argon2'):
+            return check_password_hash(self.password_hash, password)
+        try:
+            return password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    
+    def password_needs_rehash(self):
+        """Check if the stored hash is legacy pbkdf2 or uses outdated argon2 parameters"""
+        if not self.password_hash.startswith('$argon2'):
+            return True
+        return password_hasher.check_needs_rehash(self.password_hash)
     
     def __repr__(self):
         return f'<User {self.email}>'
@@ -58,7 +84,7 @@ class Vital(db.Model):
     __tablename__ = 'vitals'
     
     id = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)  # Indexed by ix_vital_patient_recorded
     
     # Vital signs
     heart_rate = db.Column(db.Float)
@@ -76,17 +102,22 @@ class Vital(db.Model):
     def __repr__(self):
         return f'<Vital {self.id} for Patient {self.patient_id}>'
 
+# Composite indexes for the per-patient "latest first" queries
+db.Index('ix_vital_patient_recorded', Vital.patient_id, Vital.recorded_at.desc())
+
 class Anomaly(db.Model):
     """Anomaly detection model"""
     __tablename__ = 'anomalies'
     
     id = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
-    assigned_doctor_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True, index=True)
+    # Both lead composite indexes below, which serve plain lookups too
+    patient_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    assigned_doctor_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
     transferred_from_doctor_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
     
     anomaly_type = db.Column(db.String(200), nullable=False)
     severity = db.Column(db.String(20), nullable=False)  # 'low', 'medium', 'high', 'critical'
+    severity_rank = db.Column(db.SmallInteger, default=default_severity_rank)  # 1=low ... 4=critical
     description = db.Column(db.Text)
     risk_score = db.Column(db.Float)
     
@@ -97,23 +128,76 @@ class Anomaly(db.Model):
     def __repr__(self):
         return f'<Anomaly {self.id} - {self.anomaly_type}>'
 
+db.Index('ix_anomaly_patient_detected', Anomaly.patient_id, Anomaly.detected_at.desc())
+db.Index('ix_anomaly_patient_status_detected', Anomaly.patient_id, Anomaly.case_status, Anomaly.detected_at.desc())
+db.Index('ix_anomaly_doctor_detected', Anomaly.assigned_doctor_id, Anomaly.detected_at.desc())
+
 class Alert(db.Model):
     """Alert model for notifications"""
     __tablename__ = 'alerts'
     
     id = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)  # Indexed by ix_alert_patient_unread_created
     
     alert_type = db.Column(db.String(100), nullable=False)
     message = db.Column(db.Text, nullable=False)
     severity = db.Column(db.String(20), nullable=False)  # 'low', 'medium', 'high', 'critical'
-    is_read = db.Column(db.Boolean, default=False, index=True)
+    is_read = db.Column(db.Boolean, default=False)
     
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
     
     def __repr__(self):
         return f'<Alert {self.id} - {self.alert_type}>'
 
+db.Index('ix_alert_patient_unread_created', Alert.patient_id, Alert.is_read, Alert.created_at.desc())
+
+class Prediction(db.Model):
+    """Heal.io model output for a vitals upload, filled in by a background job"""
+    __tablename__ = 'predictions'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    status = db.Column(db.String(20), default='pending', nullable=False)  # 'pending', 'complete', 'failed'
+    anomalies_created = db.Column(db.Integer, default=0)
+    
+    alert = db.Column(db.String(20))  # 'NORMAL', 'EARLY WARNING', 'HIGH RISK'
+    quantum_score = db.Column(db.Float)
+    classical_score = db.Column(db.Float)
+    cardio_risk = db.Column(db.Float)
+    respiratory_risk = db.Column(db.Float)
+    metabolic_risk = db.Column(db.Float)
+    neurological_risk = db.Column(db.Float)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    def set_result(self, result):
+        """Copy a healio_predict result dict onto this row"""
+        risks = result.get('risks', {})
+        self.alert = result.get('alert', 'NORMAL')
+        self.quantum_score = result.get('quantum_score')
+        self.classical_score = result.get('classical_score')
+        self.cardio_risk = risks.get('cardio')
+        self.respiratory_risk = risks.get('respiratory')
+        self.metabolic_risk = risks.get('metabolic')
+        self.neurological_risk = risks.get('neurological')
+    
+    def to_dict(self):
+        """Same shape as the healio_predict result the templates expect"""
+        return {
+            'alert': self.alert,
+            'quantum_score': self.quantum_score,
+            'classical_score': self.classical_score,
+            'risks': {
+                'cardio': self.cardio_risk,
+                'respiratory': self.respiratory_risk,
+                'metabolic': self.metabolic_risk,
+                'neurological': self.neurological_risk
+            }
+        }
+    
+    def __repr__(self):
+        return f'<Prediction {self.id} - {self.alert}>'
+
 class PatientDoctor(db.Model):
     """Relationship model between patients and doctors"""
     __tablename__ = 'patient_doctors'
@@ -0,0 +1,8 @@
+"""
+WSGI entry point for Heal.io
+
+    gunicorn wsgi:app
+"""
+from app import app
+
+__all__ = ['app']